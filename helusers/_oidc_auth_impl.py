@@ -1,13 +1,14 @@
 import logging
 
-from cachetools.func import ttl_cache
 from django.utils import timezone
 from django.utils.encoding import smart_str
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext as _
 from jose import JWTError
 from rest_framework.authentication import BaseAuthentication, get_authorization_header
 from rest_framework.exceptions import AuthenticationFailed
 
+from .api_use import record_last_api_use
 from .authz import UserAuthorization
 from .jwt import JWT, ValidationError
 from .settings import api_token_auth_settings
@@ -27,11 +28,10 @@ class ApiTokenAuthentication(BaseAuthentication):
     def auth_scheme(self):
         return self.settings.AUTH_SCHEME or "Bearer"
 
-    @ttl_cache(ttl=api_token_auth_settings.OIDC_CONFIG_EXPIRATION_TIME)
     def get_oidc_config(self, issuer):
-        from helusers.oidc import OIDCConfig
+        from helusers.oidc import issuer_registry
 
-        return OIDCConfig(issuer)
+        return issuer_registry.get(issuer)
 
     def authenticate(self, request):
         jwt_value = self.get_jwt_value(request)
@@ -45,20 +45,31 @@ class ApiTokenAuthentication(BaseAuthentication):
 
         logger.debug(f"Token payload decoded as: {payload}")
 
+        if self.settings.LAZY_USER_RESOLUTION:
+            user = SimpleLazyObject(lambda: self.resolve_user(request, payload))
+        else:
+            user = self.resolve_user(request, payload)
+        auth = UserAuthorization(user, payload, self.settings)
+
+        return user, auth
+
+    def resolve_user(self, request, payload):
+        """Resolves the user of an authenticated request using the
+        USER_RESOLVER setting and records the API use for the user."""
         user_resolver = self.settings.USER_RESOLVER  # Default: resolve_user
         try:
             user = user_resolver(request, payload)
         except ValueError as e:
             raise AuthenticationFailed(str(e)) from e
-        auth = UserAuthorization(user, payload, self.settings)
 
         if user and hasattr(user, "last_api_use"):
             today = timezone.now().date()
             if not user.last_api_use or user.last_api_use < today:
                 user.last_api_use = today
-                user.save(update_fields=["last_api_use"])
+                if not record_last_api_use(user.pk, today):
+                    user.save(update_fields=["last_api_use"])
 
-        return user, auth
+        return user
 
     def decode_jwt(self, jwt_value):
         jwt = JWT(jwt_value, settings=self.settings)
@@ -68,9 +79,17 @@ class ApiTokenAuthentication(BaseAuthentication):
         except ValidationError as e:
             raise AuthenticationFailed(str(e)) from e
 
-        keys = self.get_oidc_config(jwt.issuer).keys()
+        audience = self.settings.AUDIENCE
+        try:
+            verified = jwt.load_verified_claims(audience)
+        except Exception:
+            raise AuthenticationFailed("JWT verification failed.")
+        if not verified:
+            keys = self.get_oidc_config(jwt.issuer).key_set(jwt.key_id)
         try:
-            jwt.validate(keys, self.settings.AUDIENCE)
+            if not verified:
+                jwt.validate(keys, audience)
+                jwt.save_verified_claims(audience)
             jwt.validate_api_scope()
             jwt.validate_session()
             self.validate_claims(jwt.claims)
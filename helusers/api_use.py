@@ -0,0 +1,229 @@
+import atexit
+import datetime
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections
+from django.db.models import Q
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+_defaults = dict(
+    CACHE=None,
+    FLUSH_INTERVAL=60,
+    TIMEOUT=2 * 24 * 60 * 60,
+)
+
+_CACHE_KEY_PREFIX = "helusers:last_api_use"
+
+
+def _get_settings():
+    buffer_settings = getattr(settings, "HELUSERS_LAST_API_USE_BUFFER", None)
+    if buffer_settings is None:
+        return None
+
+    result = _defaults.copy()
+    result.update(buffer_settings)
+    return result
+
+
+class MemoryBuffer:
+    """Buffers the API use dates in the memory of the current process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def record(self, user_id, date):
+        with self._lock:
+            if self._pending.get(user_id, datetime.date.min) < date:
+                self._pending[user_id] = date
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        for user_id, date in pending.items():
+            self.record(user_id, date)
+
+
+class CacheBuffer:
+    """Buffers the API use dates in a Django cache shared by the processes.
+
+    Every recorded date is stored as a separately numbered cache entry, so
+    that the buffer can be drained without listing the keys of the cache.
+    Each user is recorded at most once per date."""
+
+    def __init__(self, alias, timeout):
+        self._alias = alias
+        self._timeout = timeout
+
+    @property
+    def _cache(self):
+        return caches[self._alias]
+
+    def record(self, user_id, date):
+        seen_key = f"{_CACHE_KEY_PREFIX}:seen:{date.isoformat()}:{user_id}"
+        if self._cache.add(seen_key, True, self._timeout):
+            self._append(user_id, date)
+
+    def _append(self, user_id, date):
+        counter_key = f"{_CACHE_KEY_PREFIX}:counter"
+        self._cache.add(counter_key, 0, None)
+        index = self._cache.incr(counter_key)
+        self._cache.set(
+            f"{_CACHE_KEY_PREFIX}:entry:{index}",
+            (user_id, date.isoformat()),
+            self._timeout,
+        )
+
+    def drain(self):
+        cache = self._cache
+        last = cache.get(f"{_CACHE_KEY_PREFIX}:counter", 0)
+        drained = cache.get(f"{_CACHE_KEY_PREFIX}:drained", 0)
+        if last <= drained:
+            return {}
+
+        # An entry whose number has been taken but which hasn't been stored
+        # yet is lost. That only delays the user's API use date by a day.
+        keys = [f"{_CACHE_KEY_PREFIX}:entry:{i}" for i in range(drained + 1, last + 1)]
+        entries = cache.get_many(keys)
+        cache.set(f"{_CACHE_KEY_PREFIX}:drained", last, None)
+        cache.delete_many(keys)
+
+        pending = {}
+        for user_id, date in entries.values():
+            date = datetime.date.fromisoformat(date)
+            if pending.get(user_id, datetime.date.min) < date:
+                pending[user_id] = date
+        return pending
+
+    def restore(self, pending):
+        for user_id, date in pending.items():
+            self._append(user_id, date)
+
+
+class _Flusher(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="helusers-last-api-use-flusher", daemon=True)
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                flush_last_api_use()
+            except Exception:
+                logger.exception("Failed to flush the last API use dates")
+            finally:
+                connections.close_all()
+
+    def stop(self):
+        self._stopped.set()
+
+
+_lock = threading.Lock()
+_buffer = None
+_flusher = None
+
+
+def _get_buffer():
+    global _buffer, _flusher
+
+    if _buffer is not None:
+        return _buffer
+
+    with _lock:
+        if _buffer is None:
+            buffer_settings = _get_settings()
+            if buffer_settings is None:
+                return None
+
+            if buffer_settings["CACHE"] is None:
+                _buffer = MemoryBuffer()
+            else:
+                _buffer = CacheBuffer(
+                    buffer_settings["CACHE"], buffer_settings["TIMEOUT"]
+                )
+
+            if buffer_settings["FLUSH_INTERVAL"] is not None:
+                _flusher = _Flusher(buffer_settings["FLUSH_INTERVAL"])
+                _flusher.start()
+        return _buffer
+
+
+def record_last_api_use(user_id, date):
+    """Records that the user with the given primary key used the API on the
+    given date. Returns False if buffering is disabled by the
+    HELUSERS_LAST_API_USE_BUFFER setting, in which case the caller needs
+    to save the date itself."""
+    buffer = _get_buffer()
+    if buffer is None:
+        return False
+
+    buffer.record(user_id, date)
+    return True
+
+
+def flush_last_api_use():
+    """Writes the buffered API use dates to the users. Users having the
+    same date are updated with a single query. Returns the number of
+    updated users."""
+    buffer = _get_buffer()
+    if buffer is None:
+        return 0
+
+    pending = buffer.drain()
+    user_ids_by_date = defaultdict(list)
+    for user_id, date in pending.items():
+        user_ids_by_date[date].append(user_id)
+
+    user_model = get_user_model()
+    updated = 0
+    try:
+        for date, user_ids in sorted(user_ids_by_date.items()):
+            updated += (
+                user_model.objects.filter(pk__in=user_ids)
+                .filter(Q(last_api_use__isnull=True) | Q(last_api_use__lt=date))
+                .update(last_api_use=date)
+            )
+            for user_id in user_ids:
+                del pending[user_id]
+    except Exception:
+        buffer.restore(pending)
+        raise
+
+    return updated
+
+
+def _reset():
+    global _buffer, _flusher
+
+    with _lock:
+        if _flusher is not None:
+            _flusher.stop()
+        _buffer = None
+        _flusher = None
+
+
+@atexit.register
+def _flush_at_exit():
+    if isinstance(_buffer, MemoryBuffer):
+        try:
+            flush_last_api_use()
+        except Exception:
+            logger.exception("Failed to flush the last API use dates")
+
+
+@receiver(setting_changed)
+def _reload_settings(setting, **kwargs):
+    if setting == "HELUSERS_LAST_API_USE_BUFFER":
+        _reset()
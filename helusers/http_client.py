@@ -0,0 +1,94 @@
+import threading
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_defaults = dict(
+    CONNECT_TIMEOUT=5,
+    READ_TIMEOUT=10,
+    RETRIES=2,
+    BACKOFF_FACTOR=0.5,
+    POOL_CONNECTIONS=10,
+    POOL_MAXSIZE=10,
+)
+
+_lock = threading.Lock()
+_session = None
+
+
+def _get_settings():
+    client_settings = _defaults.copy()
+    client_settings.update(getattr(settings, "HELUSERS_HTTP_CLIENT", {}))
+    return client_settings
+
+
+def _build_session(client_settings):
+    # Only idempotent requests are retried. The last response is returned
+    # as is when retries run out, so that callers can check its status.
+    retry = Retry(
+        total=client_settings["RETRIES"],
+        backoff_factor=client_settings["BACKOFF_FACTOR"],
+        status_forcelist=(502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=client_settings["POOL_CONNECTIONS"],
+        pool_maxsize=client_settings["POOL_MAXSIZE"],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the requests Session shared by all the outbound HTTP calls
+    made by helusers. The session keeps connections to the servers alive
+    and reuses them between requests."""
+    global _session
+
+    session = _session
+    if session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session(_get_settings())
+            session = _session
+    return session
+
+
+def request(method, url, **kwargs):
+    """Makes an HTTP request using the shared session. Unless a timeout is
+    given, the connect and read timeouts from the HELUSERS_HTTP_CLIENT
+    setting are used."""
+    if "timeout" not in kwargs:
+        client_settings = _get_settings()
+        kwargs["timeout"] = (
+            client_settings["CONNECT_TIMEOUT"],
+            client_settings["READ_TIMEOUT"],
+        )
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+@receiver(setting_changed)
+def _reload_settings(setting, **kwargs):
+    global _session
+    if setting == "HELUSERS_HTTP_CLIENT":
+        with _lock:
+            if _session is not None:
+                _session.close()
+            _session = None
@@ -9,8 +9,22 @@ try:
 except ImportError:
     pass
 
+import binascii
+import hashlib
+import json
+import threading
+import time
+from collections.abc import Mapping
+
+from cachetools import LRUCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.encoding import smart_bytes
 from django.utils.functional import cached_property
-from jose import jwt
+from jose import ExpiredSignatureError, JWTError, jwk, jwt
+from jose.constants import ALGORITHMS
+from jose.exceptions import JWTClaimsError
+from jose.utils import base64url_decode
 
 from .models import OIDCBackChannelLogoutEvent
 from .settings import api_token_auth_settings
@@ -22,40 +36,285 @@ class ValidationError(Exception):
     pass
 
 
+class ParsedToken:
+    """An encoded JWS split into its parts, which are decoded exactly once.
+
+    Raises a JWTError if the input can't be decoded."""
+
+    __slots__ = ("header", "claims", "signing_input", "signature")
+
+    def __init__(self, encoded_jwt):
+        if isinstance(encoded_jwt, str):
+            encoded_jwt = encoded_jwt.encode("utf-8")
+
+        try:
+            signing_input, crypto_segment = encoded_jwt.rsplit(b".", 1)
+            header_segment, claims_segment = signing_input.split(b".", 1)
+            header = json.loads(base64url_decode(header_segment))
+            claims = json.loads(base64url_decode(claims_segment))
+            signature = base64url_decode(crypto_segment)
+        except (ValueError, TypeError, binascii.Error) as e:
+            raise JWTError(f"Error decoding token: {e}") from e
+
+        if not isinstance(header, Mapping):
+            raise JWTError("Invalid header string: must be a json object")
+        if not isinstance(claims, Mapping):
+            raise JWTError("Invalid payload string: must be a json object")
+
+        self.header = header
+        self.claims = claims
+        self.signing_input = signing_input
+        self.signature = signature
+
+    def verify_signature(self, keys, algorithms):
+        """Verifies the signature using any of the given key objects.
+        Raises a JWTError if none of them matches."""
+        alg = self.header.get("alg")
+        if not alg:
+            raise JWTError("No algorithm was specified in the JWS header.")
+        if alg not in algorithms:
+            raise JWTError("The specified alg value is not allowed")
+
+        for key in keys:
+            try:
+                if key.verify(self.signing_input, self.signature):
+                    return
+            except Exception:
+                pass
+
+        raise JWTError("Signature verification failed.")
+
+
+def _validate_registered_claims(claims, required_claims):
+    """Validates the registered claims the same way jose.jwt.decode does,
+    except for the audience."""
+    for required_claim in required_claims:
+        if required_claim not in claims:
+            raise JWTError(f'missing required key "{required_claim}" among claims')
+
+    now = int(time.time())
+
+    if "iat" in claims:
+        try:
+            int(claims["iat"])
+        except ValueError:
+            raise JWTClaimsError("Issued At claim (iat) must be an integer.")
+
+    if "nbf" in claims:
+        try:
+            nbf = int(claims["nbf"])
+        except ValueError:
+            raise JWTClaimsError("Not Before claim (nbf) must be an integer.")
+        if nbf > now:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+
+    if "exp" in claims:
+        try:
+            exp = int(claims["exp"])
+        except ValueError:
+            raise JWTClaimsError("Expiration Time claim (exp) must be an integer.")
+        if exp < now:
+            raise ExpiredSignatureError("Signature has expired.")
+
+    if "sub" in claims and not isinstance(claims["sub"], str):
+        raise JWTClaimsError("Subject must be a string.")
+
+    if "jti" in claims and not isinstance(claims["jti"], str):
+        raise JWTClaimsError("JWT ID must be a string.")
+
+    if "at_hash" in claims:
+        raise JWTClaimsError(
+            "No access_token provided to compare against at_hash claim."
+        )
+
+
+_KEY_TYPE_ALGORITHMS = {
+    "RSA": ALGORITHMS.RSA_DS,
+    "EC": ALGORITHMS.EC_DS,
+    "oct": ALGORITHMS.HMAC,
+}
+
+
+class KeySet:
+    """Signature verification keys of a JWKS, indexed by "kid".
+
+    Key objects are constructed once per key and algorithm and then reused
+    for every JWT verified with the same KeySet, instead of parsing the
+    JWKS again for every JWT."""
+
+    def __init__(self, jwks):
+        self._jwks = jwks
+        self._by_kid = {}
+        self._key_objects = {}
+        for index, key_data in enumerate(jwks.get("keys", [])):
+            if key_data.get("use", "sig") != "sig":
+                continue
+            self._by_kid.setdefault(key_data.get("kid"), []).append(index)
+
+    @property
+    def jwks(self):
+        """Returns the JWKS this KeySet was built from."""
+        return self._jwks
+
+    def find(self, kid, alg):
+        """Returns the key objects that may have been used for signing a JWT
+        with the given "kid" and "alg" header values. When kid is None all the
+        keys compatible with alg are returned. As "kid" is optional in a JWKS,
+        the keys without one are returned for a kid matching no key."""
+        if kid is None:
+            indexes = [index for indexes in self._by_kid.values() for index in indexes]
+        elif kid in self._by_kid:
+            indexes = self._by_kid[kid]
+        else:
+            indexes = self._by_kid.get(None, [])
+
+        keys = []
+        for index in indexes:
+            key = self._get_key_object(index, alg)
+            if key is not None:
+                keys.append(key)
+        return keys
+
+    def __contains__(self, kid):
+        """Tells whether there are keys that may have the given kid."""
+        return kid in self._by_kid or None in self._by_kid
+
+    def _get_key_object(self, index, alg):
+        try:
+            return self._key_objects[(index, alg)]
+        except KeyError:
+            pass
+
+        key_data = self._jwks["keys"][index]
+        key = None
+        if alg in _KEY_TYPE_ALGORITHMS.get(key_data.get("kty"), ()) and (
+            key_data.get("alg", alg) == alg
+        ):
+            try:
+                key = jwk.construct(key_data, alg)
+            except Exception:
+                # Keys that can't be used are ignored
+                pass
+
+        self._key_objects[(index, alg)] = key
+        return key
+
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of the claims of already verified JWTs.
+
+    Entries are keyed by a digest of the encoded JWT and the accepted
+    audience. An entry is never used after the token's "exp" time. The
+    size of the cache is controlled by the
+    OIDC_API_TOKEN_AUTH['VERIFIED_TOKEN_CACHE_SIZE'] setting, and the
+    cache is disabled when the size is zero."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = None
+
+    def _get_cache(self):
+        if self._cache is None:
+            maxsize = api_token_auth_settings.VERIFIED_TOKEN_CACHE_SIZE
+            if not maxsize:
+                return None
+            self._cache = LRUCache(maxsize=maxsize)
+        return self._cache
+
+    @staticmethod
+    def _key(encoded_jwt, audience):
+        if not isinstance(audience, str):
+            audience = tuple(sorted(audience))
+        return hashlib.sha256(smart_bytes(encoded_jwt)).digest(), audience
+
+    def get(self, encoded_jwt, audience):
+        with self._lock:
+            cache = self._get_cache()
+            if cache is None:
+                return None
+
+            key = self._key(encoded_jwt, audience)
+            entry = cache.get(key)
+            if entry is None:
+                return None
+
+            expires_at, claims = entry
+            if time.time() >= expires_at:
+                del cache[key]
+                return None
+
+            return dict(claims)
+
+    def set(self, encoded_jwt, audience, claims):
+        expires_at = claims.get("exp")
+        if not isinstance(expires_at, (int, float)):
+            return
+
+        with self._lock:
+            cache = self._get_cache()
+            if cache is not None:
+                cache[self._key(encoded_jwt, audience)] = (expires_at, dict(claims))
+
+    def clear(self):
+        with self._lock:
+            self._cache = None
+
+
+verified_token_cache = VerifiedTokenCache()
+
+
+@receiver(setting_changed)
+def _reload_settings(setting, **kwargs):
+    if setting == "OIDC_API_TOKEN_AUTH":
+        verified_token_cache.clear()
+
+
 class JWT:
     def __init__(self, encoded_jwt, settings=None):
         """The constructor checks that a JWT can be extracted from the
         provided input but it doesn't validate it in any way. If the
         input is invalid, an exception is raised."""
         self._encoded_jwt = encoded_jwt
-        self._claims = jwt.get_unverified_claims(encoded_jwt)
+        self._token = ParsedToken(encoded_jwt)
+        self._claims = self._token.claims
         self.settings = settings or api_token_auth_settings
 
     def validate(self, keys, audience, required_claims=_NOT_PROVIDED):
-        """Verifies the JWT's signature using the provided keys,
-        and validates the claims, raising an exception if anything fails.
+        """Verifies the JWT's signature using the provided keys, which can
+        be a KeySet or a JWKS, and validates the claims, raising an exception
+        if anything fails.
         Required claims can be specified using the required_claims argument
         and it defaults to ["aud", "exp"]."""
 
         if required_claims is _NOT_PROVIDED:
             required_claims = ["aud", "exp"]
 
-        options = {
-            "verify_aud": False,
-        }
-
         require_aud = "aud" in required_claims
-        required_claims.remove("aud")
+        required_claims = [claim for claim in required_claims if claim != "aud"]
 
-        for required_claim in required_claims:
-            options[f"require_{required_claim}"] = True
+        if isinstance(keys, Mapping) and "keys" in keys:
+            keys = KeySet(keys)
 
-        jwt.decode(
-            self._encoded_jwt,
-            keys,
-            algorithms=self.settings.ALLOWED_ALGORITHMS,
-            options=options,
-        )
+        if isinstance(keys, KeySet):
+            keys = keys.find(self.key_id, self._token.header.get("alg"))
+            if not keys:
+                raise JWTError("No matching key found for the JWT.")
+
+            self._token.verify_signature(keys, self.settings.ALLOWED_ALGORITHMS)
+            _validate_registered_claims(self._token.claims, required_claims)
+        else:
+            options = {
+                "verify_aud": False,
+            }
+            for required_claim in required_claims:
+                options[f"require_{required_claim}"] = True
+
+            jwt.decode(
+                self._encoded_jwt,
+                keys,
+                algorithms=self.settings.ALLOWED_ALGORITHMS,
+                options=options,
+            )
 
         claims = self.claims
         if require_aud and "aud" not in claims:
@@ -70,6 +329,24 @@ class JWT:
             if len(set(audience).intersection(claim_audiences)) == 0:
                 raise ValidationError("Invalid audience.")
 
+    def load_verified_claims(self, audience):
+        """Looks up this JWT from the verified token cache. If the same
+        token has already been verified for the audience and it hasn't
+        expired yet, takes the previously verified claims into use and
+        returns True. Otherwise returns False and the JWT needs to be
+        validated normally."""
+        claims = verified_token_cache.get(self._encoded_jwt, audience)
+        if claims is None:
+            return False
+
+        self._claims = claims
+        return True
+
+    def save_verified_claims(self, audience):
+        """Stores the claims of this JWT into the verified token cache.
+        Should only be called after the JWT has been validated."""
+        verified_token_cache.set(self._encoded_jwt, audience, self.claims)
+
     def validate_issuer(self):
         try:
             issuer = self.issuer
@@ -102,11 +379,23 @@ class JWT:
         if OIDCBackChannelLogoutEvent.objects.is_session_terminated_for_token(self):
             raise ValidationError("Session has been terminated.")
 
+    async def avalidate_session(self):
+        if await OIDCBackChannelLogoutEvent.objects.ais_session_terminated_for_token(
+            self
+        ):
+            raise ValidationError("Session has been terminated.")
+
     @property
     def issuer(self):
         """Returns the "iss" claim value."""
         return self.claims["iss"]
 
+    @property
+    def key_id(self):
+        """Returns the "kid" header value, or None if there isn't one."""
+        key_id = self._token.header.get("kid")
+        return key_id if isinstance(key_id, str) else None
+
     @property
     def claims(self):
         """Returns all the claims of the JWT as a dictionary."""
@@ -0,0 +1,45 @@
+import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from helusers.models import (
+    OIDCBackChannelLogoutEvent,
+    OIDCSession,
+    is_session_termination_enabled,
+)
+
+
+class Command(BaseCommand):
+    help = "Delete the OIDC back channel logout events older than the retention"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention",
+            type=int,
+            help="Retention in seconds (default: the "
+            "HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION setting)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of events deleted in one transaction (default: 1000)",
+        )
+
+    def handle(self, *args, retention, chunk_size, **options):
+        if retention is not None:
+            retention = datetime.timedelta(seconds=retention)
+
+        try:
+            deleted = OIDCBackChannelLogoutEvent.objects.delete_expired(
+                retention, chunk_size
+            )
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e)) from e
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} logout events"))
+
+        if is_session_termination_enabled():
+            deleted = OIDCSession.objects.delete_expired(chunk_size)
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} OIDC sessions"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from helusers.api_use import _get_settings, flush_last_api_use
+
+
+class Command(BaseCommand):
+    help = "Write the buffered last API use dates to the users"
+
+    def handle(self, *args, **options):
+        # A buffer in the memory of the processes can't be reached from the
+        # process running this command.
+        buffer_settings = _get_settings()
+        if buffer_settings is None or buffer_settings["CACHE"] is None:
+            raise CommandError(
+                "The last API use dates can be flushed by this command only "
+                "when they are buffered in a cache, see "
+                "HELUSERS_LAST_API_USE_BUFFER['CACHE']"
+            )
+
+        updated = flush_last_api_use()
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} users"))
@@ -0,0 +1,63 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from helusers.provisioning import provision_users, read_claims
+
+
+class Command(BaseCommand):
+    help = (
+        "Create or update users from a JSON Lines file having the claims of "
+        "one user per line"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path", help="Path of the JSON Lines file, or - to read standard input"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of users saved in one transaction (default: 500)",
+        )
+        parser.add_argument(
+            "--no-oidc",
+            action="store_false",
+            dest="oidc",
+            help="Use the claims as user field values without mapping OIDC "
+            "claims, like given_name, to user fields",
+        )
+
+    def handle(self, *args, path, batch_size, oidc, **options):
+        started_at = time.monotonic()
+
+        def report(result):
+            elapsed = time.monotonic() - started_at
+            rate = result.users / elapsed if elapsed else 0
+            self.stdout.write(
+                f"{result.users} users processed, {result.created} created, "
+                f"{result.updated} updated ({rate:.0f} users/s)"
+            )
+
+        try:
+            if path == "-":
+                result = provision_users(
+                    read_claims(sys.stdin), oidc, batch_size, progress=report
+                )
+            else:
+                with open(path, encoding="utf-8") as f:
+                    result = provision_users(
+                        read_claims(f), oidc, batch_size, progress=report
+                    )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e)) from e
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Provisioned {result.users} users in {elapsed:.1f} s: "
+                f"{result.created} created, {result.updated} updated"
+            )
+        )
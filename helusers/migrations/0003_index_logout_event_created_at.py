@@ -0,0 +1,18 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helusers", "0002_add_oidcbackchannellogoutevent"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="oidcbackchannellogoutevent",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+    ]
@@ -0,0 +1,82 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def set_digests(apps, schema_editor):
+    OIDCBackChannelLogoutEvent = apps.get_model(
+        "helusers", "OIDCBackChannelLogoutEvent"
+    )
+    fields = ["iss_digest", "sub_digest", "sid_digest"]
+    events = []
+    for event in OIDCBackChannelLogoutEvent.objects.only("iss", "sub", "sid").iterator(
+        chunk_size=1000
+    ):
+        event.iss_digest = _digest(event.iss)
+        event.sub_digest = _digest(event.sub)
+        event.sid_digest = _digest(event.sid)
+        events.append(event)
+        if len(events) == 1000:
+            OIDCBackChannelLogoutEvent.objects.bulk_update(events, fields)
+            events = []
+
+    if events:
+        OIDCBackChannelLogoutEvent.objects.bulk_update(events, fields)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helusers", "0003_index_logout_event_created_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="oidcbackchannellogoutevent",
+            name="iss_digest",
+            field=models.CharField(default="", editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="oidcbackchannellogoutevent",
+            name="sub_digest",
+            field=models.CharField(default="", editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="oidcbackchannellogoutevent",
+            name="sid_digest",
+            field=models.CharField(default="", editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_digests, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name="oidcbackchannellogoutevent",
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name="oidcbackchannellogoutevent",
+            name="iss",
+            field=models.CharField(max_length=4096),
+        ),
+        migrations.AlterField(
+            model_name="oidcbackchannellogoutevent",
+            name="sub",
+            field=models.CharField(blank=True, max_length=4096),
+        ),
+        migrations.AlterField(
+            model_name="oidcbackchannellogoutevent",
+            name="sid",
+            field=models.CharField(blank=True, max_length=4096),
+        ),
+        migrations.AddConstraint(
+            model_name="oidcbackchannellogoutevent",
+            constraint=models.UniqueConstraint(
+                fields=("iss_digest", "sid_digest", "sub_digest"),
+                name="helusers_logout_event_unique_digests",
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helusers", "0004_add_logout_event_digests"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OIDCSession",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                ("session_key", models.CharField(max_length=40, unique=True)),
+                ("iss", models.CharField(max_length=4096)),
+                ("sub", models.CharField(blank=True, max_length=4096)),
+                ("sid", models.CharField(blank=True, max_length=4096)),
+                ("iss_digest", models.CharField(editable=False, max_length=64)),
+                ("sub_digest", models.CharField(editable=False, max_length=64)),
+                ("sid_digest", models.CharField(editable=False, max_length=64)),
+            ],
+            options={
+                "verbose_name": "OIDC session",
+                "verbose_name_plural": "OIDC sessions",
+                "indexes": [
+                    models.Index(
+                        fields=["iss_digest", "sid_digest"],
+                        name="helusers_oidc_session_sid",
+                    ),
+                    models.Index(
+                        fields=["iss_digest", "sub_digest"],
+                        name="helusers_oidc_session_sub",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+from django.db import migrations, models
+
+
+def _repoint(model, field_name, other_field_name, keeper_id, duplicate_id):
+    # Rows of the duplicate whose other end is already linked to the
+    # keeper would violate the uniqueness of the pair, so they are dropped.
+    rows = model.objects.filter(**{field_name: duplicate_id})
+    rows.filter(
+        **{
+            f"{other_field_name}__in": model.objects.filter(
+                **{field_name: keeper_id}
+            ).values(other_field_name)
+        }
+    ).delete()
+    rows.update(**{field_name: keeper_id})
+
+
+def merge_duplicate_ad_groups(apps, schema_editor):
+    ADGroup = apps.get_model("helusers", "ADGroup")
+    ADGroupMapping = apps.get_model("helusers", "ADGroupMapping")
+
+    duplicate_names = (
+        ADGroup.objects.values("name")
+        .annotate(count=models.Count("id"))
+        .filter(count__gt=1)
+        .values_list("name", flat=True)
+    )
+    for name in list(duplicate_names):
+        keeper_id, *duplicate_ids = (
+            ADGroup.objects.filter(name=name)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        for duplicate_id in duplicate_ids:
+            for relation in ADGroup._meta.related_objects:
+                if relation.many_to_many:
+                    # The users' ad_groups relation
+                    _repoint(
+                        relation.through,
+                        relation.field.m2m_reverse_field_name(),
+                        relation.field.m2m_field_name(),
+                        keeper_id,
+                        duplicate_id,
+                    )
+                elif relation.related_model is ADGroupMapping:
+                    _repoint(
+                        ADGroupMapping, "ad_group", "group", keeper_id, duplicate_id
+                    )
+                else:
+                    relation.related_model.objects.filter(
+                        **{relation.field.name: duplicate_id}
+                    ).update(**{relation.field.name: keeper_id})
+        ADGroup.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helusers", "0005_oidcsession"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_ad_groups, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="adgroup",
+            name="name",
+            field=models.CharField(max_length=200),
+        ),
+        migrations.AddConstraint(
+            model_name="adgroup",
+            constraint=models.UniqueConstraint(
+                fields=("name",), name="helusers_adgroup_unique_name"
+            ),
+        ),
+    ]
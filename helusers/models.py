@@ -1,11 +1,25 @@
+import datetime
+import hashlib
 import logging
+import threading
+import time
 import uuid
 from collections import defaultdict
+from importlib import import_module
 from itertools import chain
 
+from asgiref.sync import sync_to_async
+from cachetools import LRUCache
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser as DjangoAbstractUser
 from django.contrib.auth.models import Group
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
@@ -16,7 +30,7 @@ logger = logging.getLogger(__name__)
 
 class ADGroup(models.Model):
     # Because AD group names are case insensitive, name is saved as lowercase.
-    name = models.CharField(max_length=200, db_index=True)
+    name = models.CharField(max_length=200)
     display_name = models.CharField(max_length=200)
 
     def save(self, *args, **kwargs):
@@ -26,6 +40,34 @@ class ADGroup(models.Model):
     def __str__(self):
         return self.display_name
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["name"], name="helusers_adgroup_unique_name"
+            ),
+        ]
+
+
+def get_or_create_ad_groups(display_names):
+    """Makes sure there's an ADGroup for each of the given AD groups, which
+    are given as a dict from the lowercase name to the display name.
+    Returns a dict from the names to the ids of the ADGroups. Groups
+    created concurrently by another process are used as they are."""
+    ad_groups = dict(
+        ADGroup.objects.filter(name__in=display_names).values_list("name", "id")
+    )
+    missing_ad_groups = [
+        ADGroup(name=name, display_name=display_name)
+        for name, display_name in display_names.items()
+        if name not in ad_groups
+    ]
+    if missing_ad_groups:
+        ADGroup.objects.bulk_create(missing_ad_groups, ignore_conflicts=True)
+        ad_groups = dict(
+            ADGroup.objects.filter(name__in=display_names).values_list("name", "id")
+        )
+    return ad_groups
+
 
 class ADGroupMapping(models.Model):
     group = models.ForeignKey(
@@ -44,6 +86,135 @@ class ADGroupMapping(models.Model):
         verbose_name_plural = _("AD group mappings")
 
 
+class ADGroupMappingIndex:
+    """An immutable index of the Django groups mapped to each AD group."""
+
+    def __init__(self, mappings):
+        groups_by_ad_group = defaultdict(set)
+        for ad_group, group in mappings:
+            groups_by_ad_group[ad_group].add(group)
+
+        self._groups_by_ad_group = {
+            ad_group: frozenset(groups)
+            for ad_group, groups in groups_by_ad_group.items()
+        }
+        self.all_groups = frozenset(chain(*self._groups_by_ad_group.values()))
+
+    def groups_for(self, ad_groups):
+        """Returns the ids of the Django groups mapped to the given AD group ids."""
+        return set(chain(*(self._groups_by_ad_group.get(x, ()) for x in ad_groups)))
+
+
+_AD_GROUP_MAPPING_VERSION_KEY = "helusers:ad_group_mapping:version"
+
+_ad_group_mapping_lock = threading.Lock()
+_ad_group_mapping = (None, None)
+
+# The AD groups of the users and the version of the mapping their Django
+# groups were last synced with. Bounded, so that the memory use stays
+# constant.
+_MAX_SYNCED_USERS = 10000
+_synced_users_lock = threading.Lock()
+_synced_users = LRUCache(maxsize=_MAX_SYNCED_USERS)
+
+
+def _is_synced(user_id, ad_groups, version):
+    if version is None:
+        return False
+    with _synced_users_lock:
+        return _synced_users.get(user_id) == (version, ad_groups)
+
+
+def _set_synced(user_id, ad_groups, version):
+    if version is None:
+        return
+    with _synced_users_lock:
+        _synced_users[user_id] = (version, ad_groups)
+
+
+def _get_ad_group_mapping_cache():
+    alias = getattr(settings, "HELUSERS_AD_GROUP_MAPPING_CACHE", None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_ad_group_mapping_version():
+    """Returns the current version of the AD group mapping, or None if the
+    HELUSERS_AD_GROUP_MAPPING_CACHE setting is not set."""
+    cache = _get_ad_group_mapping_cache()
+    if cache is None:
+        return None
+
+    version = cache.get(_AD_GROUP_MAPPING_VERSION_KEY)
+    if version is None:
+        cache.add(_AD_GROUP_MAPPING_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(_AD_GROUP_MAPPING_VERSION_KEY)
+    return version
+
+
+async def aget_ad_group_mapping_version():
+    """Async version of get_ad_group_mapping_version()."""
+    cache = _get_ad_group_mapping_cache()
+    if cache is None:
+        return None
+
+    version = await cache.aget(_AD_GROUP_MAPPING_VERSION_KEY)
+    if version is None:
+        await cache.aadd(_AD_GROUP_MAPPING_VERSION_KEY, uuid.uuid4().hex, None)
+        version = await cache.aget(_AD_GROUP_MAPPING_VERSION_KEY)
+    return version
+
+
+def get_ad_group_mapping():
+    """Returns an ADGroupMappingIndex of all the AD group mappings.
+
+    If the HELUSERS_AD_GROUP_MAPPING_CACHE setting names a Django cache,
+    the index is kept in memory until the version of the mapping stored in
+    that cache changes. The version is changed whenever an ADGroupMapping
+    is saved or deleted, so the processes sharing the cache all notice the
+    change."""
+    global _ad_group_mapping
+
+    version = get_ad_group_mapping_version()
+    if version is not None:
+        cached_version, mapping = _ad_group_mapping
+        if cached_version == version:
+            return mapping
+
+    mapping = ADGroupMappingIndex(
+        ADGroupMapping.objects.values_list("ad_group", "group")
+    )
+    if version is not None:
+        with _ad_group_mapping_lock:
+            _ad_group_mapping = (version, mapping)
+    return mapping
+
+
+def _invalidate_ad_group_mapping():
+    cache = _get_ad_group_mapping_cache()
+    if cache is not None:
+        cache.set(_AD_GROUP_MAPPING_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(post_save, sender=ADGroupMapping)
+@receiver(post_delete, sender=ADGroupMapping)
+def _ad_group_mapping_changed(**kwargs):
+    _invalidate_ad_group_mapping()
+    # Other processes may have reloaded the old mapping before the
+    # transaction was committed
+    transaction.on_commit(_invalidate_ad_group_mapping)
+
+
+@receiver(setting_changed)
+def _reload_settings(setting, **kwargs):
+    global _ad_group_mapping
+    if setting == "HELUSERS_AD_GROUP_MAPPING_CACHE":
+        _ad_group_mapping = (None, None)
+        with _synced_users_lock:
+            _synced_users.clear()
+
+
 class AbstractUser(DjangoAbstractUser):
     uuid = models.UUIDField(unique=True)
     department_name = models.CharField(max_length=50, null=True, blank=True)
@@ -88,22 +259,21 @@ class AbstractUser(DjangoAbstractUser):
     def natural_key(self):
         return (str(self.uuid),)
 
-    def sync_groups_from_ad(self):
-        """Determine which Django groups to add or remove based on AD groups."""
+    def sync_groups_from_ad(self, ad_group_ids=None):
+        """Determine which Django groups to add or remove based on AD groups.
 
-        ad_list = ADGroupMapping.objects.values_list("ad_group", "group")
-        mappings = defaultdict(list)
-        for ad_group, group in ad_list:
-            mappings[ad_group].append(group)
+        The ids of the user's AD groups are queried unless given."""
 
-        user_ad_groups = set(
-            self.ad_groups.filter(groups__isnull=False).values_list(flat=True)
-        )
-        all_mapped_groups = set(chain(*mappings.values()))
+        mapping = get_ad_group_mapping()
+        if not mapping.all_groups:
+            return
+
+        if ad_group_ids is None:
+            ad_group_ids = set(self.ad_groups.values_list("id", flat=True))
         old_groups = set(
-            self.groups.filter(id__in=all_mapped_groups).values_list(flat=True)
+            self.groups.filter(id__in=mapping.all_groups).values_list(flat=True)
         )
-        new_groups = set(chain(*[mappings[x] for x in user_ad_groups]))
+        new_groups = mapping.groups_for(ad_group_ids)
 
         groups_to_delete = old_groups - new_groups
         if groups_to_delete:
@@ -112,24 +282,37 @@ class AbstractUser(DjangoAbstractUser):
         if groups_to_add:
             self.groups.add(*groups_to_add)
 
-    @transaction.atomic
     def update_ad_groups(self, ad_group_names):
+        # AD group names are case insensitive, the first given casing is
+        # used as the display name of a new group.
+        display_names = {}
+        for name in ad_group_names:
+            display_names.setdefault(name.lower(), name)
+
+        old_ad_groups = dict(self.ad_groups.values_list("name", "id"))
+        old_ids = frozenset(old_ad_groups.values())
+        version = get_ad_group_mapping_version()
+        if old_ad_groups.keys() == display_names.keys():
+            # The Django groups need to be synced again only if the mapping
+            # has changed since they were last synced
+            if _is_synced(self.pk, old_ids, version):
+                return
+            self.sync_groups_from_ad(old_ids)
+            _set_synced(self.pk, old_ids, version)
+            return
+
+        new_ids = self._update_ad_groups(display_names, old_ids)
+        _set_synced(self.pk, new_ids, version)
+
+    @transaction.atomic
+    def _update_ad_groups(self, display_names, old_ad_groups):
         # Lock the User object to prevent races
         user = type(self).objects.select_for_update().get(id=self.id)
 
-        # Make sure there's an ADGroup object for each group
-        lower_names = [x.lower() for x in ad_group_names]
-        ad_groups = {
-            x.name.lower(): x for x in ADGroup.objects.filter(name__in=lower_names)
-        }
-        for name in ad_group_names:
-            n = name.lower()
-            if n not in ad_groups:
-                ad_groups[n] = ADGroup.objects.create(name=n, display_name=name)
+        ad_groups = get_or_create_ad_groups(display_names)
 
         # Update user's groups
-        new_ad_groups = {x.id for x in ad_groups.values()}
-        old_ad_groups = {x.id for x in user.ad_groups.all()}
+        new_ad_groups = frozenset(ad_groups.values())
         groups_to_add = new_ad_groups - old_ad_groups
         if groups_to_add:
             user.ad_groups.add(*groups_to_add)
@@ -137,7 +320,8 @@ class AbstractUser(DjangoAbstractUser):
         if groups_to_remove:
             user.ad_groups.remove(*groups_to_remove)
 
-        user.sync_groups_from_ad()
+        user.sync_groups_from_ad(new_ad_groups)
+        return new_ad_groups
 
     def __str__(self):
         if self.first_name and self.last_name:
@@ -150,6 +334,139 @@ class AbstractUser(DjangoAbstractUser):
         ordering = ("id",)
 
 
+class TerminatedSessionIndex:
+    """In-memory index of the sessions terminated by back channel logouts.
+
+    The index is refreshed from the database at most once per the given
+    interval. After the initial load, only the events created since the
+    latest event seen are read. Logout events received in this process
+    are added to the index right away."""
+
+    # The created_at of an event is set before the event is committed, so
+    # an event may become visible after events created later than it.
+    # Events this close to the latest event seen are read again.
+    OVERLAP = datetime.timedelta(minutes=1)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Both map to the creation time of the latest event
+            self._sessions = {}
+            self._subjects = {}
+            self._latest_created_at = None
+            self._refreshed_at = None
+
+    def _add(self, iss, sub, sid, created_at):
+        if sid:
+            self._sessions[(iss, sid)] = created_at
+        elif sub:
+            key = (iss, sub)
+            if self._subjects.get(key, created_at) <= created_at:
+                self._subjects[key] = created_at
+
+    def add(self, iss, sub, sid):
+        with self._lock:
+            self._add(iss, sub, sid, timezone.now())
+
+    def refresh(self, interval):
+        """Reads the new events from the database if the index hasn't been
+        refreshed during the interval, which is in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed_at is not None and now - self._refreshed_at < interval:
+                return
+
+            events = OIDCBackChannelLogoutEvent.objects.all()
+            if self._latest_created_at is not None:
+                events = events.filter(
+                    created_at__gte=self._latest_created_at - self.OVERLAP
+                )
+            for iss, sub, sid, created_at in events.values_list(
+                "iss", "sub", "sid", "created_at"
+            ):
+                self._add(iss, sub, sid, created_at)
+                if self._latest_created_at is None or (
+                    created_at > self._latest_created_at
+                ):
+                    self._latest_created_at = created_at
+
+            retention = _get_logout_event_retention()
+            if retention is not None:
+                expired_at = timezone.now() - retention
+                self._sessions = {
+                    key: created_at
+                    for key, created_at in self._sessions.items()
+                    if created_at >= expired_at
+                }
+                self._subjects = {
+                    key: created_at
+                    for key, created_at in self._subjects.items()
+                    if created_at >= expired_at
+                }
+            self._refreshed_at = now
+
+    def needs_refresh(self, interval):
+        """Tells whether refresh() would read the database, without
+        waiting for the lock."""
+        refreshed_at = self._refreshed_at
+        return refreshed_at is None or time.monotonic() - refreshed_at >= interval
+
+    def is_terminated(self, iss, sid, sub=None, issued_at=None):
+        """Checks if the session sid has been terminated. If sub and
+        issued_at are given, also checks if all the sessions of the subject
+        have been terminated after the second issued_at."""
+        if sid and (iss, sid) in self._sessions:
+            return True
+        if sub and issued_at is not None:
+            terminated_at = self._subjects.get((iss, sub))
+            if terminated_at is not None:
+                return terminated_at >= issued_at + _ISSUED_AT_RESOLUTION
+        return False
+
+
+terminated_session_index = TerminatedSessionIndex()
+
+
+def _get_terminated_session_index_interval():
+    return getattr(
+        settings, "HELUSERS_BACK_CHANNEL_LOGOUT_INDEX_REFRESH_INTERVAL", None
+    )
+
+
+def _get_logout_event_retention():
+    retention = getattr(settings, "HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION", None)
+    if retention is None:
+        return None
+    return datetime.timedelta(seconds=retention)
+
+
+def _is_sub_termination_enabled():
+    return getattr(settings, "HELUSERS_BACK_CHANNEL_LOGOUT_SUB_TERMINATION", False)
+
+
+# The "iat" claim is truncated to seconds, so a token is known to have been
+# issued before a logout only if the logout was received in a later second.
+_ISSUED_AT_RESOLUTION = datetime.timedelta(seconds=1)
+
+
+def _get_issued_at(token):
+    try:
+        return datetime.datetime.fromtimestamp(
+            int(token.claims["iat"]), tz=datetime.timezone.utc
+        )
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+@receiver(setting_changed)
+def _reload_terminated_session_index(setting, **kwargs):
+    if setting == "HELUSERS_BACK_CHANNEL_LOGOUT_INDEX_REFRESH_INTERVAL":
+        terminated_session_index.clear()
+
+
 class OIDCBackChannelLogoutEventManager(models.Manager):
     def logout_token_received(self, logout_token):
         sub = logout_token.claims.get("sub", "")
@@ -161,23 +478,247 @@ class OIDCBackChannelLogoutEventManager(models.Manager):
         except IntegrityError:
             pass
 
-    def is_session_terminated_for_token(self, token):
+        if _get_terminated_session_index_interval() is not None:
+            terminated_session_index.add(logout_token.issuer, sub, sid)
+
+    def _get_termination_check(self, token):
+        """Returns the arguments of the termination check of the token, or
+        None if the token can't have been terminated."""
         sid = token.claims.get("sid")
+        sub = token.claims.get("sub") if _is_sub_termination_enabled() else None
+        issued_at = _get_issued_at(token) if sub else None
+        if issued_at is None:
+            # Without the issue time it's unknown whether the token was
+            # issued before or after a logout of the subject
+            sub = None
+        if not sid and not sub:
+            return None
+        return token.issuer, sid, sub, issued_at
+
+    def _terminating_events(self, iss, sid, sub, issued_at):
+        conditions = models.Q()
         if sid:
-            return self.filter(iss=token.issuer, sid=sid).exists()
+            conditions |= models.Q(sid_digest=logout_event_digest(sid))
+        if sub:
+            # Events without a sid terminate all the sessions of the subject
+            conditions |= models.Q(
+                sid_digest=logout_event_digest(""),
+                sub_digest=logout_event_digest(sub),
+                created_at__gte=issued_at + _ISSUED_AT_RESOLUTION,
+            )
 
-        return False
+        return self.filter(conditions, iss_digest=logout_event_digest(iss))
+
+    def is_session_terminated_for_token(self, token):
+        """Checks if the token's session has been terminated.
+
+        If the HELUSERS_BACK_CHANNEL_LOGOUT_SUB_TERMINATION setting is True,
+        the token is also terminated by logout events having only the "sub"
+        claim of the token, if they were received after the second in the
+        "iat" claim of the token. Tokens without the "iat" claim are
+        checked only by their session.
+
+        If the HELUSERS_BACK_CHANNEL_LOGOUT_INDEX_REFRESH_INTERVAL setting
+        is set, the check is done using the TerminatedSessionIndex,
+        otherwise the database is queried once."""
+        check = self._get_termination_check(token)
+        if check is None:
+            return False
+
+        interval = _get_terminated_session_index_interval()
+        if interval is not None:
+            terminated_session_index.refresh(interval)
+            return terminated_session_index.is_terminated(*check)
+
+        return self._terminating_events(*check).exists()
+
+    def delete_expired(self, retention=None, chunk_size=1000):
+        """Deletes the logout events older than the retention, which is a
+        timedelta and defaults to the
+        HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION setting. The events are
+        deleted in chunks of chunk_size events, each in its own transaction,
+        so that the table is never locked for long. Returns the number of
+        deleted events."""
+        if retention is None:
+            retention = _get_logout_event_retention()
+            if retention is None:
+                raise ImproperlyConfigured(
+                    "HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION is not set"
+                )
+
+        expired = self.filter(created_at__lt=timezone.now() - retention)
+        return _delete_in_chunks(expired, chunk_size)
+
+    async def ais_session_terminated_for_token(self, token):
+        check = self._get_termination_check(token)
+        if check is None:
+            return False
+
+        interval = _get_terminated_session_index_interval()
+        if interval is not None:
+            if terminated_session_index.needs_refresh(interval):
+                await sync_to_async(terminated_session_index.refresh)(interval)
+            return terminated_session_index.is_terminated(*check)
+
+        return await self._terminating_events(*check).aexists()
+
+
+def _delete_in_chunks(queryset, chunk_size):
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by("pk").values_list("pk", flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            deleted += queryset.filter(pk__in=ids).delete()[0]
+
+
+def logout_event_digest(value):
+    """Returns the digest of an iss, sub or sid value used for looking up
+    the logout events."""
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
 
 
 class OIDCBackChannelLogoutEvent(models.Model):
-    created_at = models.DateTimeField(default=timezone.now, blank=False)
-    iss = models.CharField(max_length=4096, db_index=True)
-    sub = models.CharField(max_length=4096, blank=True, db_index=True)
-    sid = models.CharField(max_length=4096, blank=True, db_index=True)
+    created_at = models.DateTimeField(default=timezone.now, blank=False, db_index=True)
+    iss = models.CharField(max_length=4096)
+    sub = models.CharField(max_length=4096, blank=True)
+    sid = models.CharField(max_length=4096, blank=True)
+    # Fixed width digests of the above, which are indexed instead of the
+    # possibly very long values.
+    iss_digest = models.CharField(max_length=64, editable=False)
+    sub_digest = models.CharField(max_length=64, editable=False)
+    sid_digest = models.CharField(max_length=64, editable=False)
 
     objects = OIDCBackChannelLogoutEventManager()
 
+    def save(self, *args, **kwargs):
+        self.iss_digest = logout_event_digest(self.iss)
+        self.sub_digest = logout_event_digest(self.sub)
+        self.sid_digest = logout_event_digest(self.sid)
+        return super().save(*args, **kwargs)
+
     class Meta:
-        unique_together = ["iss", "sub", "sid"]
+        constraints = [
+            # The column order makes the index usable for looking up
+            # events by iss and sid too.
+            models.UniqueConstraint(
+                fields=["iss_digest", "sid_digest", "sub_digest"],
+                name="helusers_logout_event_unique_digests",
+            ),
+        ]
         verbose_name = "OIDC back channel logout event"
         verbose_name_plural = "OIDC back channel logout events"
+
+
+def is_session_termination_enabled():
+    return getattr(settings, "HELUSERS_BACK_CHANNEL_LOGOUT_SESSION_TERMINATION", False)
+
+
+# Name of the Django session entry holding the OIDC session of a login
+# until the session key is known.
+OIDC_SESSION_SESSION_KEY = "helusers_oidc_session"
+
+
+class OIDCSessionManager(models.Manager):
+    def session_logged_in(self, session_key, iss, sub, sid):
+        """Records that the Django session session_key belongs to the OIDC
+        session sid of the subject sub at the issuer iss."""
+        with transaction.atomic():
+            self.filter(session_key=session_key).delete()
+            self.create(session_key=session_key, iss=iss, sub=sub, sid=sid)
+
+    def logout_token_received(self, logout_token):
+        """Deletes the Django sessions of the OIDC session terminated by the
+        logout token. A logout token without the "sid" claim terminates all
+        the sessions of its subject if the
+        HELUSERS_BACK_CHANNEL_LOGOUT_SUB_TERMINATION setting is True.
+        Returns the number of deleted sessions."""
+        sid = logout_token.claims.get("sid")
+        sub = logout_token.claims.get("sub")
+        if sid:
+            sessions = self.filter(sid_digest=logout_event_digest(sid))
+        elif sub and _is_sub_termination_enabled():
+            sessions = self.filter(sub_digest=logout_event_digest(sub))
+        else:
+            return 0
+
+        sessions = sessions.filter(iss_digest=logout_event_digest(logout_token.issuer))
+        session_keys = list(sessions.values_list("session_key", flat=True))
+        if not session_keys:
+            return 0
+
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        for session_key in session_keys:
+            session_store(session_key=session_key).delete()
+        self.filter(session_key__in=session_keys).delete()
+        return len(session_keys)
+
+    def delete_expired(self, chunk_size=1000):
+        """Deletes the sessions created more than SESSION_COOKIE_AGE seconds
+        ago in chunks of chunk_size sessions. Returns the number of deleted
+        sessions."""
+        expired_at = timezone.now() - datetime.timedelta(
+            seconds=settings.SESSION_COOKIE_AGE
+        )
+        return _delete_in_chunks(self.filter(created_at__lt=expired_at), chunk_size)
+
+
+class OIDCSession(models.Model):
+    """Maps an OIDC session to the Django session it was logged in to, so
+    that a back channel logout can delete the Django session."""
+
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    session_key = models.CharField(max_length=40, unique=True)
+    iss = models.CharField(max_length=4096)
+    sub = models.CharField(max_length=4096, blank=True)
+    sid = models.CharField(max_length=4096, blank=True)
+    iss_digest = models.CharField(max_length=64, editable=False)
+    sub_digest = models.CharField(max_length=64, editable=False)
+    sid_digest = models.CharField(max_length=64, editable=False)
+
+    objects = OIDCSessionManager()
+
+    def save(self, *args, **kwargs):
+        self.iss_digest = logout_event_digest(self.iss)
+        self.sub_digest = logout_event_digest(self.sub)
+        self.sid_digest = logout_event_digest(self.sid)
+        return super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["iss_digest", "sid_digest"],
+                name="helusers_oidc_session_sid",
+            ),
+            models.Index(
+                fields=["iss_digest", "sub_digest"],
+                name="helusers_oidc_session_sub",
+            ),
+        ]
+        verbose_name = "OIDC session"
+        verbose_name_plural = "OIDC sessions"
+
+
+@receiver(user_logged_in)
+def _record_oidc_session(request, **kwargs):
+    # The session key changes on login, so the OIDC session stored by the
+    # social auth pipeline is recorded only after that.
+    session = getattr(request, "session", None)
+    if session is None:
+        return
+    oidc_session = session.pop(OIDC_SESSION_SESSION_KEY, None)
+    if oidc_session is None or not is_session_termination_enabled():
+        return
+    if session.session_key is None:
+        session.save()
+    OIDCSession.objects.session_logged_in(session.session_key, **oidc_session)
+
+
+@receiver(user_logged_out)
+def _forget_oidc_session(request, **kwargs):
+    if not is_session_termination_enabled():
+        return
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key is not None:
+        OIDCSession.objects.filter(session_key=session.session_key).delete()
@@ -4,30 +4,320 @@ except ImportError:
     pass
 
 
-import requests
-from cachetools.func import ttl_cache
+import hashlib
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
 from django.core.signals import setting_changed
 from django.dispatch import receiver
 from django.utils.functional import cached_property
 
+from . import http_client
 from .authz import UserAuthorization
-from .jwt import JWT, ValidationError
+from .jwt import JWT, KeySet, ValidationError
 from .settings import api_token_auth_settings
-from .user_utils import get_or_create_user
+from .user_utils import aget_or_create_user, get_or_create_user
+
+logger = logging.getLogger(__name__)
+
+KeyCacheInfo = namedtuple("KeyCacheInfo", ["hits", "misses"])
+
+_MAX_UNKNOWN_KEY_IDS = 1000
 
 
 class OIDCConfig:
+    # Minimum time in seconds between the start of a failed background
+    # refresh and the next one, so that a failing issuer isn't refetched
+    # back to back.
+    REFRESH_RETRY_DELAY = 10
+
     def __init__(self, issuer):
         self._issuer = issuer
+        self._lock = threading.Lock()
+        self._key_set = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._refresh_failed_at = None
+        self._last_forced_fetch = None
+        self._forced_fetching = False
+        self._unknown_key_ids = set()
+        self._hits = 0
+        self._misses = 0
 
-    @ttl_cache(ttl=api_token_auth_settings.OIDC_CONFIG_EXPIRATION_TIME)
     def keys(self):
+        """Returns the issuer's JWKS."""
+        return self.key_set().jwks
+
+    def key_set(self, key_id=None):
+        """Returns the issuer's keys as a KeySet. The keys are fetched from
+        the issuer at most once per OIDC_CONFIG_EXPIRATION_TIME and shared
+        by all the threads using this object.
+
+        If OIDC_CONFIG_REFRESH_AHEAD_TIME is set, the keys are refreshed in a
+        background thread starting that many seconds before they expire.
+        Until the refresh completes the previous keys are used, even after
+        they have expired.
+
+        If key_id is given and there's no key with that id, the issuer has
+        probably rotated its keys and they are fetched again immediately,
+        but at most once per OIDC_CONFIG_UNKNOWN_KID_REFETCH_INTERVAL."""
+        key_set = self._get_key_set()
+        if key_id is None or key_id in key_set:
+            return key_set
+
+        return self._fetch_for_unknown_key_id(key_id)
+
+    def _get_key_set(self):
+        with self._lock:
+            now = time.monotonic()
+            key_set = self._get_stored_key_set(now)
+            if key_set is not None:
+                return key_set
+
+            self._misses += 1
+            jwks, age = self._load_keys()
+            self._store(jwks, now - age)
+            return self._key_set
+
+    def _get_stored_key_set(self, now):
+        # Must be called while holding the lock. Returns None if the keys
+        # need to be fetched.
+        refresh_ahead_time = api_token_auth_settings.OIDC_CONFIG_REFRESH_AHEAD_TIME
+        key_set = self._key_set
+        if key_set is None:
+            return None
+
+        if now < self._expires_at:
+            self._hits += 1
+            if (
+                refresh_ahead_time is not None
+                and now >= self._expires_at - refresh_ahead_time
+            ):
+                self._start_background_refresh(now)
+            return key_set
+
+        if refresh_ahead_time is not None:
+            self._hits += 1
+            self._start_background_refresh(now)
+            return key_set
+
+        return None
+
+    async def akey_set(self, key_id=None):
+        """Async version of key_set(). If the keys need to be fetched, or
+        another thread is holding the lock, the keys are looked up in a
+        worker thread so that the event loop isn't blocked."""
+        if self._lock.acquire(blocking=False):
+            try:
+                key_set = self._get_stored_key_set(time.monotonic())
+            finally:
+                self._lock.release()
+            if key_set is not None and (key_id is None or key_id in key_set):
+                return key_set
+
+        return await sync_to_async(self.key_set, thread_sensitive=False)(key_id)
+
+    def cache_info(self):
+        return KeyCacheInfo(self._hits, self._misses)
+
+    def _fetch_for_unknown_key_id(self, key_id):
+        interval = api_token_auth_settings.OIDC_CONFIG_UNKNOWN_KID_REFETCH_INTERVAL
+
+        with self._lock:
+            key_set = self._key_set
+            # Another thread may have fetched the key already
+            if key_id in key_set:
+                return key_set
+
+            # Key ids still missing after a fetch are remembered until the
+            # keys change, so that forged key ids don't cause any fetches.
+            if interval is None or key_id in self._unknown_key_ids:
+                return key_set
+
+            now = time.monotonic()
+            if self._forced_fetching or (
+                self._last_forced_fetch is not None
+                and now < self._last_forced_fetch + interval
+            ):
+                return key_set
+
+            self._last_forced_fetch = now
+            self._forced_fetching = True
+            self._misses += 1
+
+        # The keys are fetched without holding the lock, so that only the
+        # caller with the unknown key id waits for the fetch. The others
+        # keep using the current keys.
+        try:
+            jwks, age = self._load_keys(force=True)
+        except Exception:
+            # The current keys are returned, so that the token fails
+            # verification like any token signed with an unknown key.
+            logger.exception(
+                f"Fetching the keys of issuer {self._issuer} for key id {key_id} failed"
+            )
+            with self._lock:
+                self._forced_fetching = False
+                if len(self._unknown_key_ids) < _MAX_UNKNOWN_KEY_IDS:
+                    self._unknown_key_ids.add(key_id)
+                return self._key_set
+
+        with self._lock:
+            self._forced_fetching = False
+            self._store(jwks, now - age)
+            if (
+                key_id not in self._key_set
+                and len(self._unknown_key_ids) < _MAX_UNKNOWN_KEY_IDS
+            ):
+                self._unknown_key_ids.add(key_id)
+            return self._key_set
+
+    def _store(self, jwks, fetched_at):
+        self._key_set = KeySet(jwks)
+        self._unknown_key_ids = set()
+        self._expires_at = (
+            fetched_at + api_token_auth_settings.OIDC_CONFIG_EXPIRATION_TIME
+        )
+
+    def _start_background_refresh(self, now):
+        # Must be called while holding the lock. At most one refresh per
+        # issuer is in flight at a time.
+        if self._refreshing:
+            return
+        if (
+            self._refresh_failed_at is not None
+            and now < self._refresh_failed_at + self.REFRESH_RETRY_DELAY
+        ):
+            return
+
+        self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        refresh_ahead_time = api_token_auth_settings.OIDC_CONFIG_REFRESH_AHEAD_TIME
+        now = time.monotonic()
+        try:
+            jwks, age = self._load_keys(min_time_left=refresh_ahead_time or 0)
+        except Exception:
+            logger.exception(f"Refreshing the keys of issuer {self._issuer} failed")
+            jwks = None
+
+        with self._lock:
+            if jwks is not None:
+                self._store(jwks, now - age)
+                self._refresh_failed_at = None
+            else:
+                self._refresh_failed_at = now
+            self._refreshing = False
+
+    def _load_keys(self, force=False, min_time_left=0):
+        """Returns the issuer's JWKS and its age in seconds.
+
+        If OIDC_CONFIG_CACHE names a Django cache, the discovery document
+        and the JWKS are shared through it with the other processes. A
+        shared JWKS is used unless force is True or the JWKS would expire
+        in less than min_time_left seconds. If force is True, the discovery
+        document is fetched again too, in case the "jwks_uri" has changed."""
+        cache = _get_shared_cache()
+        if cache is None:
+            return self._fetch_keys(force), 0
+
+        expiration_time = api_token_auth_settings.OIDC_CONFIG_EXPIRATION_TIME
+        cache_key = self._cache_key("jwks")
+        if not force:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                age = max(time.time() - entry["fetched_at"], 0)
+                if expiration_time - age > min_time_left:
+                    return entry["jwks"], age
+
+        fetched_at = time.time()
+        jwks = self._fetch_keys(force)
+        cache.set(cache_key, {"jwks": jwks, "fetched_at": fetched_at}, expiration_time)
+        return jwks, 0
+
+    def _cache_key(self, name):
+        digest = hashlib.sha256(self._issuer.encode("utf-8")).hexdigest()
+        return f"helusers:oidc:{name}:{digest}"
+
+    def _get_configuration(self, force=False):
+        cache = _get_shared_cache()
+        if cache is not None and not force:
+            configuration = cache.get(self._cache_key("configuration"))
+            if configuration is not None:
+                return configuration
+
         config_url = self._issuer + "/.well-known/openid-configuration"
-        config = requests.get(config_url).json()
+        response = http_client.get(config_url)
+        response.raise_for_status()
+        configuration = response.json()
+
+        if cache is not None:
+            cache.set(
+                self._cache_key("configuration"),
+                configuration,
+                api_token_auth_settings.OIDC_CONFIG_EXPIRATION_TIME,
+            )
+        return configuration
+
+    def _fetch_keys(self, force=False):
+        keys_url = self._get_configuration(force)["jwks_uri"]
+        response = http_client.get(keys_url)
+        response.raise_for_status()
+        return response.json()
+
 
-        keys_url = config["jwks_uri"]
-        return requests.get(keys_url).json()
+def _get_shared_cache():
+    alias = api_token_auth_settings.OIDC_CONFIG_CACHE
+    if not alias:
+        return None
+    return caches[alias]
+
+
+class IssuerRegistry:
+    """Process-wide registry of OIDCConfig objects, one per issuer.
+
+    All the token authentication classes and the back channel logout view
+    share the same registry, so that the keys of an issuer are fetched
+    only once per expiration period regardless of how many authenticator
+    instances there are."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._configs = {}
+
+    def get(self, issuer):
+        try:
+            return self._configs[issuer]
+        except KeyError:
+            pass
+
+        with self._lock:
+            config = self._configs.get(issuer)
+            if config is None:
+                config = OIDCConfig(issuer)
+                self._configs[issuer] = config
+            return config
+
+    def key_set(self, issuer, key_id=None):
+        return self.get(issuer).key_set(key_id)
+
+    def cache_info(self):
+        """Returns the key cache statistics of each known issuer as a
+        dictionary of issuer to KeyCacheInfo."""
+        return {issuer: config.cache_info() for issuer, config in self._configs.items()}
+
+    def clear(self):
+        with self._lock:
+            self._configs = {}
+
+
+issuer_registry = IssuerRegistry()
 
 
 def _build_defaults():
@@ -57,15 +347,24 @@ def _build_defaults():
         def configs(self):
             configs = dict()
             for issuer in self.issuers:
-                configs[issuer] = OIDCConfig(issuer)
+                configs[issuer] = issuer_registry.get(issuer)
             return configs
 
         @cached_property
         def key_provider(self):
             confs = self.configs
 
-            def _key_provider(issuer):
-                return confs[issuer].keys()
+            def _key_provider(issuer, key_id=None):
+                return confs[issuer].key_set(key_id)
+
+            return _key_provider
+
+        @cached_property
+        def async_key_provider(self):
+            confs = self.configs
+
+            async def _key_provider(issuer, key_id=None):
+                return await confs[issuer].akey_set(key_id)
 
             return _key_provider
 
@@ -79,11 +378,19 @@ _defaults = _build_defaults()
 def _reload_settings(setting, **kwargs):
     if setting == "OIDC_API_TOKEN_AUTH":
         global _defaults
+        issuer_registry.clear()
         _defaults = _build_defaults()
 
 
-def get_keys(issuer):
-    return _defaults.key_provider(issuer)
+def get_keys(issuer, key_id=None):
+    """Returns the issuer's JWKS."""
+    return _defaults.key_provider(issuer, key_id).jwks
+
+
+def get_key_set(issuer, key_id=None):
+    """Returns the issuer's keys as a KeySet. The keys are fetched again
+    if key_id is given and there's no key with that id."""
+    return _defaults.key_provider(issuer, key_id)
 
 
 def accepted_audience():
@@ -109,6 +416,16 @@ class RequestJWTAuthentication:
                 stacklevel=2,
             )
 
+    def _get_jwt(self, request):
+        try:
+            auth_header = request.headers["Authorization"]
+            auth_scheme, jwt_value = auth_header.split()
+            if auth_scheme.lower() != "bearer":
+                return None
+            return JWT(jwt_value)
+        except Exception:
+            return None
+
     def authenticate(self, request):
         """Looks for a JWT from the request's "Authorization" header. If the header
         is not found, or it doesn't contain a JWT, returns None.
@@ -118,13 +435,8 @@ class RequestJWTAuthentication:
         Creates a User if it doesn't already exist. On success returns a
         UserAuthorization object. Raises an AuthenticationError on authentication
         failure."""
-        try:
-            auth_header = request.headers["Authorization"]
-            auth_scheme, jwt_value = auth_header.split()
-            if auth_scheme.lower() != "bearer":
-                return None
-            jwt = JWT(jwt_value)
-        except Exception:
+        jwt = self._get_jwt(request)
+        if jwt is None:
             return None
 
         try:
@@ -132,9 +444,17 @@ class RequestJWTAuthentication:
         except ValidationError as e:
             raise AuthenticationError(str(e)) from e
 
-        keys = _defaults.key_provider(jwt.issuer)
+        audience = _defaults.audience
         try:
-            jwt.validate(keys, _defaults.audience)
+            verified = jwt.load_verified_claims(audience)
+        except Exception:
+            raise AuthenticationError("JWT verification failed.")
+        if not verified:
+            keys = _defaults.key_provider(jwt.issuer, jwt.key_id)
+        try:
+            if not verified:
+                jwt.validate(keys, audience)
+                jwt.save_verified_claims(audience)
             jwt.validate_api_scope()
             jwt.validate_session()
         except ValidationError as e:
@@ -145,3 +465,41 @@ class RequestJWTAuthentication:
         claims = jwt.claims
         user = get_or_create_user(claims, oidc=True)
         return UserAuthorization(user, claims)
+
+    async def aauthenticate(self, request):
+        """Async version of authenticate(). Fetching the keys and verifying
+        the JWT's signature are done in worker threads, and the user is
+        looked up using the async ORM interface, so that the event loop
+        isn't blocked."""
+        jwt = self._get_jwt(request)
+        if jwt is None:
+            return None
+
+        try:
+            jwt.validate_issuer()
+        except ValidationError as e:
+            raise AuthenticationError(str(e)) from e
+
+        audience = _defaults.audience
+        try:
+            verified = jwt.load_verified_claims(audience)
+        except Exception:
+            raise AuthenticationError("JWT verification failed.")
+        if not verified:
+            keys = await _defaults.async_key_provider(jwt.issuer, jwt.key_id)
+        try:
+            if not verified:
+                await sync_to_async(jwt.validate, thread_sensitive=False)(
+                    keys, audience
+                )
+                jwt.save_verified_claims(audience)
+            jwt.validate_api_scope()
+            await jwt.avalidate_session()
+        except ValidationError as e:
+            raise AuthenticationError(str(e)) from e
+        except Exception:
+            raise AuthenticationError("JWT verification failed.")
+
+        claims = jwt.claims
+        user = await aget_or_create_user(claims, oidc=True)
+        return UserAuthorization(user, claims)
@@ -1,10 +1,11 @@
 import logging
 from datetime import datetime, timedelta
 
-import requests
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
+from . import http_client
+from .models import OIDC_SESSION_SESSION_KEY, is_session_termination_enabled
 from .tunnistamo_oidc import TunnistamoOIDCAuth
 from .user_utils import convert_to_uuid, get_or_create_user, is_valid_uuid
 from .utils import uuid_to_username
@@ -95,6 +96,17 @@ def store_end_session_url(details, backend, response, user=None, *args, **kwargs
     if not request:
         return
 
+    if is_session_termination_enabled():
+        # Recorded with the session key of the login by a user_logged_in
+        # receiver, so that a back channel logout can delete the session.
+        id_token = getattr(backend, "id_token", None) or {}
+        if id_token.get("iss") and id_token.get("sid"):
+            request.session[OIDC_SESSION_SESSION_KEY] = {
+                "iss": id_token["iss"],
+                "sub": id_token.get("sub", ""),
+                "sid": id_token["sid"],
+            }
+
     end_session_url = backend.get_end_session_url(request, response["id_token"])
     if not end_session_url:
         return
@@ -131,7 +143,7 @@ def fetch_api_tokens(
 
     headers = {"Authorization": f"Bearer {social.extra_data['access_token']}"}
     url = settings.TUNNISTAMO_BASE_URL + "/api-tokens/"
-    resp = requests.post(url, headers=headers)
+    resp = http_client.post(url, headers=headers)
     if resp.status_code != 200:
         logger.error(f"Unable to get API tokens: HTTP {resp.status_code}")
         return
@@ -1,10 +1,10 @@
-import requests
 from allauth.socialaccount.providers.oauth2.views import (
     OAuth2Adapter,
     OAuth2CallbackView,
     OAuth2LoginView,
 )
 
+from ... import http_client
 from .provider import HelsinkiOIDCProvider
 
 
@@ -16,7 +16,7 @@ class HelsinkiOIDCOAuth2Adapter(OAuth2Adapter):
 
     def complete_login(self, request, app, token, **kwargs):
         headers = {"Authorization": f"Bearer {token.token}"}
-        resp = requests.get(self.profile_url, headers=headers)
+        resp = http_client.get(self.profile_url, headers=headers)
         assert resp.status_code == 200
         extra_data = resp.json()
         return self.get_provider().sociallogin_from_response(request, extra_data)
@@ -0,0 +1,188 @@
+"""Bulk provisioning of users from claim sets.
+
+Creates and updates users the same way get_or_create_user does, but a
+batch of users at a time, so that provisioning a large number of users
+needs only a handful of queries per batch."""
+
+import json
+from collections import namedtuple
+from itertools import islice
+from uuid import UUID
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .models import get_ad_group_mapping, get_or_create_ad_groups
+from .user_utils import (
+    _fingerprint_cache_key,
+    _get_ad_groups,
+    _get_fingerprint_cache,
+    _get_user_id,
+    oidc_to_user_data,
+    populate_user,
+    user_cache,
+)
+
+ProvisioningResult = namedtuple("ProvisioningResult", ["users", "created", "updated"])
+
+
+def read_claims(lines):
+    """Yields the claim sets of a JSON Lines stream, skipping empty lines.
+    Raises a ValueError telling the line number if a line isn't a JSON
+    object."""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}") from e
+        if not isinstance(payload, dict):
+            raise ValueError(f"Line {line_number}: not a JSON object")
+        yield payload
+
+
+def provision_users(payloads, oidc=True, batch_size=500, progress=None):
+    """Creates or updates a user for each of the claim sets in payloads,
+    which may be any iterable, batch_size users at a time. Each batch is
+    saved in its own transaction. The claims are mapped to the users like
+    get_or_create_user does, including the AD groups and the Django groups
+    mapped to them.
+
+    Users aren't migrated and no social accounts are created, those are
+    taken care of when the users log in. The model signals of the users
+    aren't sent.
+
+    If progress is given, it's called with the ProvisioningResult so far
+    after each batch. Returns the ProvisioningResult of all the batches."""
+    result = ProvisioningResult(0, 0, 0)
+    payloads = iter(payloads)
+    while batch := list(islice(payloads, batch_size)):
+        with transaction.atomic():
+            created, updated = _provision_batch(batch, oidc)
+        result = ProvisioningResult(
+            result.users + len(batch),
+            result.created + created,
+            result.updated + updated,
+        )
+        if progress:
+            progress(result)
+    return result
+
+
+def _provision_batch(payloads, oidc):
+    user_model = get_user_model()
+
+    # Later claim sets of the same user take precedence
+    data_by_uuid = {}
+    for payload in payloads:
+        user_id = UUID(_get_user_id(payload))
+        data_by_uuid[user_id] = oidc_to_user_data(payload) if oidc else payload
+
+    users = {
+        user.uuid: user
+        for user in user_model.objects.filter(uuid__in=data_by_uuid.keys())
+    }
+
+    new_users = []
+    changed_users = []
+    changed_fields = set()
+    for user_id, data in data_by_uuid.items():
+        user = users.get(user_id)
+        if user is None:
+            user = user_model(uuid=user_id)
+            user.set_unusable_password()
+            populate_user(user, data)
+            user.clean()
+            new_users.append(user)
+        elif fields := populate_user(user, data):
+            changed_users.append(user)
+            changed_fields.update(fields)
+
+    if new_users:
+        user_model.objects.bulk_create(new_users)
+    if changed_users:
+        user_model.objects.bulk_update(changed_users, sorted(changed_fields))
+
+    user_ids = dict(
+        user_model.objects.filter(uuid__in=data_by_uuid.keys()).values_list(
+            "uuid", "id"
+        )
+    )
+    _provision_ad_groups(data_by_uuid, user_ids)
+
+    for user_id in users:
+        user_cache.delete(user_id)
+    cache = _get_fingerprint_cache()
+    if cache is not None:
+        cache.delete_many([_fingerprint_cache_key(user_id) for user_id in users])
+
+    return len(new_users), len(changed_users)
+
+
+def _provision_ad_groups(data_by_uuid, user_ids):
+    ad_group_names = {}
+    for user_id, data in data_by_uuid.items():
+        names = _get_ad_groups(data)
+        if names is not None:
+            ad_group_names[user_ids[user_id]] = names
+    if not ad_group_names:
+        return
+
+    # AD group names are case insensitive, the first given casing is
+    # used as the display name of a new group.
+    display_names = {}
+    for names in ad_group_names.values():
+        for name in names:
+            display_names.setdefault(name.lower(), name)
+    ad_groups = get_or_create_ad_groups(display_names)
+
+    new_ad_groups = {
+        user_id: {ad_groups[name.lower()] for name in names}
+        for user_id, names in ad_group_names.items()
+    }
+    _set_relations("ad_groups", new_ad_groups)
+
+    mapping = get_ad_group_mapping()
+    if mapping.all_groups:
+        new_groups = {
+            user_id: mapping.groups_for(ad_group_ids)
+            for user_id, ad_group_ids in new_ad_groups.items()
+        }
+        _set_relations("groups", new_groups, limit_to=mapping.all_groups)
+
+
+def _set_relations(field_name, new_relations, limit_to=None):
+    """Makes the many-to-many field of the users match new_relations, which
+    is a dict from user ids to sets of related ids, using one query for
+    reading, adding and removing the relations each. If limit_to is given,
+    only the related ids in it are added or removed."""
+    field = get_user_model()._meta.get_field(field_name)
+    through = field.remote_field.through
+    user_column = f"{field.m2m_field_name()}_id"
+    related_column = f"{field.m2m_reverse_field_name()}_id"
+
+    existing = through.objects.filter(**{f"{user_column}__in": new_relations})
+    if limit_to is not None:
+        existing = existing.filter(**{f"{related_column}__in": limit_to})
+
+    to_remove = []
+    old_relations = {}
+    for pk, user_id, related_id in existing.values_list(
+        "pk", user_column, related_column
+    ):
+        if related_id in new_relations[user_id]:
+            old_relations.setdefault(user_id, set()).add(related_id)
+        else:
+            to_remove.append(pk)
+
+    to_add = [
+        through(**{user_column: user_id, related_column: related_id})
+        for user_id, related_ids in new_relations.items()
+        for related_id in related_ids - old_relations.get(user_id, set())
+    ]
+
+    if to_remove:
+        through.objects.filter(pk__in=to_remove).delete()
+    if to_add:
+        through.objects.bulk_create(to_add, ignore_conflicts=True)
@@ -13,8 +13,13 @@ _defaults = dict(
     ISSUER="https://tunnistamo.hel.fi",
     AUTH_SCHEME="Bearer",
     USER_RESOLVER="helusers.oidc.resolve_user",
+    LAZY_USER_RESOLUTION=False,
     OIDC_CONFIG_EXPIRATION_TIME=24 * 60 * 60,
+    OIDC_CONFIG_REFRESH_AHEAD_TIME=None,
+    OIDC_CONFIG_UNKNOWN_KID_REFETCH_INTERVAL=5 * 60,
+    OIDC_CONFIG_CACHE=None,
     ALLOWED_ALGORITHMS=["RS256"],
+    VERIFIED_TOKEN_CACHE_SIZE=0,
 )
 
 _import_strings = [
@@ -0,0 +1,134 @@
+import datetime
+import threading
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+
+from helusers._oidc_auth_impl import ApiTokenAuthentication
+from helusers.api_use import flush_last_api_use, record_last_api_use
+from helusers.tests.test_jwt_token_authentication import (  # noqa: F401
+    USER_UUID,
+    auto_auth_server,
+    do_authentication,
+)
+
+TODAY = datetime.date(2024, 5, 2)
+YESTERDAY = datetime.date(2024, 5, 1)
+
+
+def create_user(username, last_api_use=None):
+    return get_user_model().objects.create(username=username, last_api_use=last_api_use)
+
+
+def test_recording_is_disabled_by_default():
+    assert record_last_api_use(1, TODAY) is False
+    assert flush_last_api_use() == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("cache_alias", [None, "default"])
+class TestBuffer:
+    @pytest.fixture(autouse=True)
+    def enable_buffer(self, settings, cache_alias):
+        cache.clear()
+        settings.HELUSERS_LAST_API_USE_BUFFER = {
+            "CACHE": cache_alias,
+            "FLUSH_INTERVAL": None,
+        }
+        yield
+        flush_last_api_use()
+        cache.clear()
+
+    def test_authentication_records_last_api_use_without_saving_the_user(self):
+        auth = do_authentication(sut=ApiTokenAuthentication())
+        today = timezone.now().date()
+
+        assert auth.user.last_api_use == today
+        user = get_user_model().objects.get(uuid=USER_UUID)
+        assert user.last_api_use is None
+
+        assert flush_last_api_use() == 1
+
+        user.refresh_from_db()
+        assert user.last_api_use == today
+
+    def test_users_with_the_same_date_are_updated_with_one_query(
+        self, django_assert_num_queries
+    ):
+        users = [create_user(f"user-{i}") for i in range(3)]
+        for user in users:
+            record_last_api_use(user.pk, TODAY)
+
+        with django_assert_num_queries(1):
+            assert flush_last_api_use() == 3
+
+        for user in users:
+            user.refresh_from_db()
+            assert user.last_api_use == TODAY
+
+    def test_latest_date_of_a_user_is_written(self):
+        user = create_user("user")
+        record_last_api_use(user.pk, YESTERDAY)
+        record_last_api_use(user.pk, TODAY)
+
+        flush_last_api_use()
+
+        user.refresh_from_db()
+        assert user.last_api_use == TODAY
+
+    def test_later_date_in_the_database_is_not_overwritten(self):
+        user = create_user("user", last_api_use=TODAY)
+        record_last_api_use(user.pk, YESTERDAY)
+
+        assert flush_last_api_use() == 0
+
+        user.refresh_from_db()
+        assert user.last_api_use == TODAY
+
+    def test_flushed_dates_are_not_written_again(self, django_assert_num_queries):
+        user = create_user("user")
+        record_last_api_use(user.pk, TODAY)
+        flush_last_api_use()
+
+        with django_assert_num_queries(0):
+            assert flush_last_api_use() == 0
+
+    def test_dates_are_kept_when_the_update_fails(self, mocker):
+        user = create_user("user")
+        record_last_api_use(user.pk, TODAY)
+        mocker.patch("django.db.models.query.QuerySet.update", side_effect=RuntimeError)
+
+        with pytest.raises(RuntimeError):
+            flush_last_api_use()
+
+        mocker.stopall()
+        assert flush_last_api_use() == 1
+
+    def test_management_command_flushes_the_buffer(self, cache_alias):
+        user = create_user("user")
+        record_last_api_use(user.pk, TODAY)
+
+        if cache_alias is None:
+            with pytest.raises(CommandError, match="buffered in a cache"):
+                call_command("flush_last_api_use")
+            return
+
+        call_command("flush_last_api_use")
+
+        user.refresh_from_db()
+        assert user.last_api_use == TODAY
+
+
+def test_buffer_is_flushed_in_the_background(settings, mocker):
+    flushed = threading.Event()
+    mocker.patch(
+        "helusers.api_use.flush_last_api_use", side_effect=lambda: flushed.set()
+    )
+    settings.HELUSERS_LAST_API_USE_BUFFER = {"FLUSH_INTERVAL": 0.01}
+
+    record_last_api_use(1, TODAY)
+
+    assert flushed.wait(5)
@@ -1,12 +1,24 @@
+import datetime
+import io
 import re
+from types import SimpleNamespace
 
 import pytest
+from django.contrib.auth import get_user_model, login, logout
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
 from django.http import HttpRequest, HttpResponse
-from django.test import Client
+from django.test import Client, RequestFactory
 from django.urls import reverse
+from django.utils import timezone
 
 from helusers.jwt import JWT
-from helusers.models import OIDCBackChannelLogoutEvent
+from helusers.models import (
+    OIDC_SESSION_SESSION_KEY,
+    OIDCBackChannelLogoutEvent,
+    OIDCSession,
+)
+from helusers.pipeline import store_end_session_url
 
 from .conftest import AUDIENCE, ISSUER1, encoded_jwt_factory, unix_timestamp_now
 from .keys import rsa_key2
@@ -265,3 +277,122 @@ class TestUserProvidedCallback:
 
         assert response.status_code == 200
         assert OIDCBackChannelLogoutEvent.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_logged_out_user_is_removed_from_the_user_cache(mocker):
+    user_cache_delete = mocker.patch("helusers.user_utils.user_cache.delete")
+    sub = "1c9e5a3a-2f3c-4f8e-8f8e-5c5b1f0b4d8a"
+
+    execute_back_channel_logout(sub=sub)
+
+    user_cache_delete.assert_called_once_with(sub)
+
+
+@pytest.mark.django_db
+class TestSessionTermination:
+    @pytest.fixture(autouse=True)
+    def enable_session_termination(self, settings):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_SESSION_TERMINATION = True
+
+    def create_session(self, sid, sub="sub_value"):
+        session = SessionStore()
+        session.create()
+        OIDCSession.objects.session_logged_in(session.session_key, ISSUER1, sub, sid)
+        return session.session_key
+
+    def login(self, id_token):
+        user = get_user_model().objects.create(username="user")
+        request = RequestFactory().get("/")
+        request.session = SessionStore()
+        backend = SimpleNamespace(
+            id_token=id_token, get_end_session_url=lambda request, id_token: None
+        )
+
+        store_end_session_url(
+            {}, backend, {"id_token": "encoded"}, user=user, request=request
+        )
+        login(request, user, backend="django.contrib.auth.backends.ModelBackend")
+        return request
+
+    def test_login_records_the_oidc_session(self):
+        request = self.login({"iss": ISSUER1, "sub": "sub_value", "sid": "sid_value"})
+
+        oidc_session = OIDCSession.objects.get()
+        assert oidc_session.session_key == request.session.session_key
+        assert (oidc_session.iss, oidc_session.sub, oidc_session.sid) == (
+            ISSUER1,
+            "sub_value",
+            "sid_value",
+        )
+        assert OIDC_SESSION_SESSION_KEY not in request.session
+
+    def test_login_without_sid_is_not_recorded(self):
+        self.login({"iss": ISSUER1, "sub": "sub_value"})
+
+        assert not OIDCSession.objects.exists()
+
+    def test_logout_forgets_the_oidc_session(self):
+        request = self.login({"iss": ISSUER1, "sub": "sub_value", "sid": "sid_value"})
+
+        logout(request)
+
+        assert not OIDCSession.objects.exists()
+
+    def test_sessions_of_the_logged_out_sid_are_deleted(self):
+        session_key = self.create_session("sid_value")
+        other_session_key = self.create_session("other_sid")
+
+        response = execute_back_channel_logout(sid="sid_value")
+
+        assert response.status_code == 200
+        assert not SessionStore().exists(session_key)
+        assert SessionStore().exists(other_session_key)
+        assert list(OIDCSession.objects.values_list("sid", flat=True)) == ["other_sid"]
+
+    def test_sessions_of_other_issuers_are_not_deleted(self):
+        session = SessionStore()
+        session.create()
+        OIDCSession.objects.session_logged_in(
+            session.session_key, "https://other_issuer", "sub_value", "sid_value"
+        )
+
+        execute_back_channel_logout(sid="sid_value")
+
+        assert SessionStore().exists(session.session_key)
+
+    @pytest.mark.parametrize("sub_termination", [False, True])
+    def test_sub_only_logout_deletes_the_sessions_of_the_subject_if_enabled(
+        self, settings, sub_termination
+    ):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_SUB_TERMINATION = sub_termination
+        session_keys = [self.create_session("sid_1"), self.create_session("sid_2")]
+        other_session_key = self.create_session("sid_3", sub="other_sub")
+
+        execute_back_channel_logout(sub="sub_value")
+
+        for session_key in session_keys:
+            assert SessionStore().exists(session_key) is not sub_termination
+        assert SessionStore().exists(other_session_key)
+
+    def test_sessions_are_not_deleted_when_disabled(self, settings):
+        session_key = self.create_session("sid_value")
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_SESSION_TERMINATION = False
+
+        execute_back_channel_logout(sid="sid_value")
+
+        assert SessionStore().exists(session_key)
+
+    def test_management_command_deletes_expired_oidc_sessions(self, settings):
+        settings.SESSION_COOKIE_AGE = 60
+        self.create_session("new")
+        self.create_session("old")
+        OIDCSession.objects.filter(sid="old").update(
+            created_at=timezone.now() - datetime.timedelta(seconds=61)
+        )
+        stdout = io.StringIO()
+
+        call_command("delete_expired_logout_events", "--retention=60", stdout=stdout)
+
+        assert list(OIDCSession.objects.values_list("sid", flat=True)) == ["new"]
+        assert "Deleted 1 OIDC sessions" in stdout.getvalue()
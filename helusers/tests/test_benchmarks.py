@@ -0,0 +1,211 @@
+"""Benchmarks for the code paths run on every authenticated request.
+
+The benchmarks are skipped unless the HELUSERS_BENCHMARK_OUTPUT environment
+variable is set to the path of the JSON file the results are written to:
+
+    HELUSERS_BENCHMARK_OUTPUT=benchmark.json pytest helusers/tests/test_benchmarks.py
+
+The number of iterations per benchmark can be changed with the
+HELUSERS_BENCHMARK_ITERATIONS environment variable. Results contain the
+throughput and latency percentiles of each benchmark, so that they can be
+compared across releases.
+"""
+
+import json
+import os
+import platform
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+
+import django
+import pytest
+from django.contrib.auth import get_user_model
+from django.test.client import RequestFactory
+
+from helusers._oidc_auth_impl import ApiTokenAuthentication
+from helusers.jwt import JWT, KeySet
+from helusers.oidc import RequestJWTAuthentication
+from helusers.user_utils import get_or_create_user
+
+from .conftest import AUDIENCE, ISSUER1, encoded_jwt_factory, unix_timestamp_now
+from .keys import rsa_key
+
+OUTPUT_PATH = os.environ.get("HELUSERS_BENCHMARK_OUTPUT")
+ITERATIONS = int(os.environ.get("HELUSERS_BENCHMARK_ITERATIONS", "200"))
+
+pytestmark = pytest.mark.skipif(
+    not OUTPUT_PATH, reason="HELUSERS_BENCHMARK_OUTPUT is not set"
+)
+
+USER_UUID = uuid.UUID("0a5bb1aa-5a4e-4bd6-a3b2-8a0fbd0f29a1")
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+@pytest.fixture(scope="module")
+def results():
+    results = []
+    yield results
+
+    try:
+        helusers_version = version("django-helusers")
+    except PackageNotFoundError:
+        helusers_version = None
+
+    report = {
+        "created_at": datetime.now(tz=timezone.utc).isoformat(),
+        "helusers": helusers_version,
+        "django": django.get_version(),
+        "python": platform.python_version(),
+        "iterations": ITERATIONS,
+        "benchmarks": results,
+    }
+    with open(OUTPUT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+@pytest.fixture
+def benchmark(results):
+    def _benchmark(name, func, iterations=ITERATIONS, setup=None):
+        """Calls func iterations times and records its throughput and
+        latency percentiles under name. If setup is given, it is called
+        before each call to func and its return value is passed to func.
+        The time spent in setup isn't measured."""
+        latencies = []
+        for _ in range(iterations):
+            args = (setup(),) if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            latencies.append(time.perf_counter() - start)
+
+        latencies.sort()
+        total = sum(latencies)
+        results.append(
+            {
+                "name": name,
+                "iterations": iterations,
+                "ops_per_second": iterations / total if total else None,
+                "latency_seconds": {
+                    "mean": statistics.fmean(latencies),
+                    "p50": _percentile(latencies, 50),
+                    "p90": _percentile(latencies, 90),
+                    "p99": _percentile(latencies, 99),
+                    "max": latencies[-1],
+                },
+            }
+        )
+
+    return _benchmark
+
+
+def build_jwt(**claims):
+    now = unix_timestamp_now()
+    return encoded_jwt_factory(
+        iss=ISSUER1,
+        sub=str(USER_UUID),
+        aud=AUDIENCE,
+        iat=now,
+        exp=now + 600,
+        **claims,
+    )
+
+
+def build_request(**claims):
+    return RequestFactory().get(
+        "/path", HTTP_AUTHORIZATION=f"Bearer {build_jwt(**claims)}"
+    )
+
+
+def test_jwt_construction(benchmark):
+    encoded_jwt = build_jwt()
+
+    benchmark("jwt_construction", lambda: JWT(encoded_jwt))
+
+
+def test_jwt_validate(benchmark):
+    encoded_jwt = build_jwt()
+    key_set = KeySet({"keys": [rsa_key.public_key_jwk]})
+
+    benchmark("jwt_validate", lambda: JWT(encoded_jwt).validate(key_set, AUDIENCE))
+
+
+@pytest.mark.django_db
+def test_api_token_authentication(benchmark, auth_server):
+    request = build_request()
+    # DRF creates a new authentication object for every request
+    benchmark(
+        "api_token_authentication",
+        lambda: ApiTokenAuthentication().authenticate(request),
+    )
+
+
+@pytest.mark.django_db
+def test_request_jwt_authentication(benchmark, auth_server):
+    request = build_request()
+    sut = RequestJWTAuthentication()
+
+    benchmark("request_jwt_authentication", lambda: sut.authenticate(request))
+
+
+@pytest.mark.django_db
+def test_get_or_create_user_new_user(benchmark):
+    benchmark(
+        "get_or_create_user_new",
+        lambda payload: get_or_create_user(payload, oidc=True),
+        setup=lambda: {"sub": str(uuid.uuid4()), "given_name": "First"},
+    )
+
+
+@pytest.mark.django_db
+def test_get_or_create_user_existing_user(benchmark):
+    payload = {"sub": str(USER_UUID), "given_name": "First"}
+    get_or_create_user(payload, oidc=True)
+
+    benchmark(
+        "get_or_create_user_existing",
+        lambda: get_or_create_user(payload, oidc=True),
+    )
+
+
+@pytest.mark.django_db
+def test_get_or_create_user_changed_user(benchmark):
+    names = iter(range(ITERATIONS))
+
+    benchmark(
+        "get_or_create_user_changed",
+        lambda payload: get_or_create_user(payload, oidc=True),
+        setup=lambda: {"sub": str(USER_UUID), "given_name": f"Name {next(names)}"},
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("group_count", [1, 50, 500])
+def test_update_ad_groups(benchmark, group_count):
+    user_model = get_user_model()
+    iterations = max(10, ITERATIONS * 10 // group_count)
+    users = iter(
+        user_model.objects.create(uuid=uuid.uuid4(), username=f"user-{i}")
+        for i in range(iterations)
+    )
+    ad_groups = [f"ad_group_{i}" for i in range(group_count)]
+
+    benchmark(
+        f"update_ad_groups_initial_{group_count}",
+        lambda user: user.update_ad_groups(ad_groups),
+        iterations=iterations,
+        setup=lambda: next(users),
+    )
+
+    user = user_model.objects.create(uuid=uuid.uuid4(), username="unchanged")
+    user.update_ad_groups(ad_groups)
+    benchmark(
+        f"update_ad_groups_unchanged_{group_count}",
+        lambda: user.update_ad_groups(ad_groups),
+        iterations=iterations,
+    )
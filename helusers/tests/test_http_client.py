@@ -0,0 +1,51 @@
+import pytest
+
+from helusers import http_client
+
+URL = "https://example.com/resource"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(settings):
+    settings.HELUSERS_HTTP_CLIENT = {"BACKOFF_FACTOR": 0}
+
+
+def test_the_same_session_is_shared():
+    assert http_client.get_session() is http_client.get_session()
+
+
+def test_session_is_rebuilt_when_settings_change(settings):
+    session = http_client.get_session()
+
+    settings.HELUSERS_HTTP_CLIENT = {"POOL_MAXSIZE": 20}
+
+    assert http_client.get_session() is not session
+
+
+def test_timeouts_from_settings_are_used(settings, stub_responses, mocker):
+    settings.HELUSERS_HTTP_CLIENT = {"CONNECT_TIMEOUT": 1, "READ_TIMEOUT": 2}
+    stub_responses.add(method="GET", url=URL, json={})
+    send = mocker.spy(http_client.get_session(), "send")
+
+    http_client.get(URL)
+
+    assert send.call_args.kwargs["timeout"] == (1, 2)
+
+
+def test_get_requests_are_retried_on_server_errors(stub_responses):
+    stub_responses.add(method="GET", url=URL, status=503)
+    stub_responses.add(method="GET", url=URL, json={"ok": True})
+
+    response = http_client.get(URL)
+
+    assert response.json() == {"ok": True}
+    assert stub_responses.assert_call_count(URL, 2) is True
+
+
+def test_post_requests_are_not_retried(stub_responses):
+    stub_responses.add(method="POST", url=URL, status=503)
+
+    response = http_client.post(URL)
+
+    assert response.status_code == 503
+    assert stub_responses.assert_call_count(URL, 1) is True
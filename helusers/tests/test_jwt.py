@@ -0,0 +1,113 @@
+import pytest
+from jose import JWTError, jwt
+
+import helusers.jwt
+from helusers.jwt import JWT, KeySet, ParsedToken
+
+from .conftest import AUDIENCE, ISSUER1, unix_timestamp_now
+from .keys import rsa_key, rsa_key2
+
+
+def build_key_set(*keys_and_kids):
+    return KeySet(
+        {"keys": [dict(key.public_key_jwk, kid=kid) for key, kid in keys_and_kids]}
+    )
+
+
+def encode_with_kid(signing_key, kid):
+    headers = {"kid": kid} if kid else None
+    claims = {"iss": ISSUER1, "aud": AUDIENCE, "exp": unix_timestamp_now() + 10}
+    return jwt.encode(
+        claims,
+        key=signing_key.private_key_pem,
+        algorithm=signing_key.jose_algorithm,
+        headers=headers,
+    )
+
+
+def test_key_set_finds_keys_by_kid():
+    key_set = build_key_set((rsa_key, "kid1"), (rsa_key2, "kid2"))
+
+    assert "kid1" in key_set
+    assert "unknown" not in key_set
+    assert len(key_set.find("kid1", "RS256")) == 1
+    assert key_set.find("unknown", "RS256") == []
+    assert len(key_set.find(None, "RS256")) == 2
+
+
+def test_key_set_returns_keys_without_kid_for_any_kid():
+    key_set = build_key_set((rsa_key, None), (rsa_key2, "kid2"))
+
+    assert "unknown" in key_set
+    assert len(key_set.find("unknown", "RS256")) == 1
+    assert len(key_set.find("kid2", "RS256")) == 1
+
+
+def test_key_set_does_not_return_keys_of_incompatible_algorithm():
+    key_set = build_key_set((rsa_key, "kid1"))
+
+    assert key_set.find("kid1", "HS256") == []
+    assert key_set.find("kid1", "RS512") == []
+
+
+def test_key_set_constructs_each_key_only_once():
+    key_set = build_key_set((rsa_key, "kid1"))
+
+    assert key_set.find("kid1", "RS256")[0] is key_set.find(None, "RS256")[0]
+
+
+@pytest.mark.parametrize("kid", ["kid1", None])
+def test_jwt_is_verified_with_the_key_matching_its_kid(kid):
+    key_set = build_key_set((rsa_key2, "kid2"), (rsa_key, "kid1"))
+
+    JWT(encode_with_kid(rsa_key, kid)).validate(key_set, AUDIENCE)
+
+
+def test_jwt_is_not_verified_with_a_key_of_another_kid():
+    key_set = build_key_set((rsa_key2, "kid2"), (rsa_key, "kid1"))
+
+    with pytest.raises(JWTError):
+        JWT(encode_with_kid(rsa_key, "kid2")).validate(key_set, AUDIENCE)
+
+
+def test_parsed_token_decodes_the_token_parts():
+    encoded_jwt = encode_with_kid(rsa_key, "kid1")
+
+    token = ParsedToken(encoded_jwt)
+
+    assert token.header["kid"] == "kid1"
+    assert token.claims == jwt.get_unverified_claims(encoded_jwt)
+    assert token.signing_input == encoded_jwt.rsplit(".", 1)[0].encode()
+    assert not hasattr(token, "__dict__")
+
+
+@pytest.mark.parametrize(
+    "encoded_jwt", ["not_a_jwt", "a.b.c", "W10.e30.", "e30.W10.", b"\xff.e30.e30"]
+)
+def test_parsed_token_does_not_accept_invalid_input(encoded_jwt):
+    with pytest.raises(JWTError):
+        ParsedToken(encoded_jwt)
+
+
+def test_jwt_is_decoded_only_once_when_validated(mocker):
+    encoded_jwt = encode_with_kid(rsa_key, "kid1")
+    key_set = build_key_set((rsa_key, "kid1"))
+    decode = mocker.spy(helusers.jwt, "base64url_decode")
+
+    JWT(encoded_jwt).validate(key_set, AUDIENCE)
+
+    assert decode.call_count == 3
+
+
+def test_jwt_can_be_validated_with_a_jwks():
+    jwks = {"keys": [rsa_key.public_key_jwk]}
+
+    JWT(encode_with_kid(rsa_key, None)).validate(jwks, AUDIENCE)
+
+
+@pytest.mark.parametrize("as_key_set", [False, True])
+def test_jwt_with_kid_is_verified_with_a_jwks_without_kids(as_key_set):
+    jwks = {"keys": [rsa_key.public_key_jwk]}
+    keys = KeySet(jwks) if as_key_set else jwks
+
+    JWT(encode_with_kid(rsa_key, "kid1")).validate(keys, AUDIENCE)
@@ -1,9 +1,11 @@
 import uuid
 
 import pytest
+from asgiref.sync import async_to_sync
 from django.test.client import RequestFactory
 from rest_framework.exceptions import AuthenticationFailed
 
+from helusers.jwt import JWT
 from helusers.oidc import AuthenticationError, RequestJWTAuthentication
 
 from .._oidc_auth_impl import ApiTokenAuthentication
@@ -349,3 +351,118 @@ def test_token_belonging_to_a_logged_out_session_is_not_accepted(sut):
 @pytest.mark.parametrize("amr", [None, "something", ["something"], ["one", "two"]])
 def test_amr_as_string_and_list_are_both_accepted(sut, amr):
     authentication_passes(sut=sut, amr=amr)
+
+
+@pytest.mark.django_db
+class TestVerifiedTokenCache:
+    @pytest.fixture(autouse=True)
+    def enable_verified_token_cache(self, settings):
+        update_oidc_settings(settings, {"VERIFIED_TOKEN_CACHE_SIZE": 10})
+
+    @staticmethod
+    def authenticate_twice(sut, **claims):
+        now = unix_timestamp_now()
+        encoded_jwt = encoded_jwt_factory(
+            iss=ISSUER1,
+            sub=str(USER_UUID),
+            aud=AUDIENCE,
+            iat=now,
+            exp=now + 2,
+            **claims,
+        )
+        request = RequestFactory().get(
+            "/path", HTTP_AUTHORIZATION=f"Bearer {encoded_jwt}"
+        )
+        sut.authenticate(request)
+        return sut.authenticate(request)
+
+    def test_signature_is_verified_only_once_for_the_same_token(self, sut, mocker):
+        validate = mocker.spy(JWT, "validate")
+
+        assert self.authenticate_twice(sut)
+
+        assert validate.call_count == 1
+
+    def test_session_termination_is_checked_for_cached_tokens(self, sut, mocker):
+        mocker.patch(
+            "helusers.jwt.OIDCBackChannelLogoutEvent.objects.is_session_terminated_for_token",
+            side_effect=[False, True],
+        )
+
+        exception_class = AuthenticationError
+        if isinstance(sut, ApiTokenAuthentication):
+            exception_class = AuthenticationFailed
+        with pytest.raises(exception_class):
+            self.authenticate_twice(sut, sid="session")
+
+    @pytest.mark.parametrize(
+        "sut_class",
+        [
+            ApiTokenAuthentication,
+            RequestJWTAuthentication,
+            pytest.param(
+                lambda: AsyncRequestJWTAuthentication(),
+                id="AsyncRequestJWTAuthentication",
+            ),
+        ],
+    )
+    def test_token_with_non_ascii_characters_does_not_crash(self, sut_class):
+        # Depending on the decoder, the characters outside the base64
+        # alphabet are either ignored or make the token undecodable.
+        now = unix_timestamp_now()
+        encoded_jwt = encoded_jwt_factory(
+            iss=ISSUER1, sub=str(USER_UUID), aud=AUDIENCE, iat=now, exp=now + 2
+        )
+        request = RequestFactory().get(
+            "/path", HTTP_AUTHORIZATION=f"Bearer {encoded_jwt}éé"
+        )
+        sut = sut_class()
+
+        # The second call looks the token up from the cache
+        for _ in range(2):
+            sut.authenticate(request)
+
+    def test_expired_tokens_are_not_used_from_the_cache(self, sut, mocker):
+        validate = mocker.spy(JWT, "validate")
+        mocker.patch("helusers.jwt.time.time", return_value=unix_timestamp_now() + 2)
+
+        assert self.authenticate_twice(sut)
+
+        assert validate.call_count == 2
+
+
+class AsyncRequestJWTAuthentication(RequestJWTAuthentication):
+    """Runs the async authentication path through the sync interface used
+    by the test helpers."""
+
+    def authenticate(self, request):
+        return async_to_sync(self.aauthenticate)(request)
+
+
+@pytest.mark.django_db
+class TestAsyncAuthentication:
+    @pytest.fixture
+    def sut(self):
+        return AsyncRequestJWTAuthentication()
+
+    def test_valid_jwt_is_accepted(self, sut):
+        authentication_passes(sut=sut)
+
+    def test_existing_user_is_updated(self, sut, django_user_model):
+        django_user_model.objects.create(uuid=USER_UUID, first_name="Old")
+
+        auth = do_authentication(sut=sut, given_name="New")
+
+        assert auth.user.first_name == "New"
+        assert django_user_model.objects.get(uuid=USER_UUID).first_name == "New"
+
+    def test_invalid_signature_is_not_accepted(self, sut):
+        authentication_does_not_pass(sut=sut, signing_key=rsa_key2)
+
+    def test_token_belonging_to_a_logged_out_session_is_not_accepted(self, sut):
+        execute_back_channel_logout(iss=ISSUER1, sub=str(USER_UUID), sid="session")
+
+        authentication_does_not_pass(sut=sut, sid="session")
+
+    def test_missing_jwt_is_skipped(self, sut):
+        authentication_is_skipped(sut=sut, auth_scheme="Auth")
@@ -110,3 +110,18 @@ def test_get_or_create_user_migrate_user(
         assert user_model.objects.filter(uuid=old_uuid).exists()
         assert user.uuid == new_uuid
         assert user.username == uuid_to_username(new_uuid)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("user_exists", [True, False])
+def test_migration_is_checked_only_once_per_user(
+    user_exists, django_assert_num_queries
+):
+    new_uuid = uuid.uuid4()
+    if user_exists:
+        get_user_model().objects.create(uuid=new_uuid, username="new")
+    payload = {"sub": str(new_uuid), "amr": ["a"], "email": "auser@example.org"}
+    migrate_user(user_id=str(new_uuid), payload=payload)
+
+    with django_assert_num_queries(0):
+        migrate_user(user_id=str(new_uuid), payload=payload)
@@ -1,11 +1,31 @@
+import datetime
+import io
+
 import pytest
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+import helusers.models
 from helusers.jwt import JWT
-from helusers.models import ADGroup, ADGroupMapping, OIDCBackChannelLogoutEvent
+from helusers.models import (
+    ADGroup,
+    ADGroupMapping,
+    OIDCBackChannelLogoutEvent,
+    aget_ad_group_mapping_version,
+    get_ad_group_mapping,
+    get_ad_group_mapping_version,
+    get_or_create_ad_groups,
+    logout_event_digest,
+)
 
-from .conftest import ISSUER1, encoded_jwt_factory
+from .conftest import ISSUER1, encoded_jwt_factory, unix_timestamp_now
 
 user_model = get_user_model()
 
@@ -58,6 +78,23 @@ class TestOIDCBackChannelLogoutEvent:
             is False
         )
 
+    def test_sessions_are_looked_up_by_digests(self):
+        logout_token = JWT(encoded_jwt_factory(iss=ISSUER1, sid="sid_value"))
+        OIDCBackChannelLogoutEvent.objects.logout_token_received(logout_token)
+
+        event = OIDCBackChannelLogoutEvent.objects.get()
+        assert event.iss_digest == logout_event_digest(ISSUER1)
+        assert event.sid_digest == logout_event_digest("sid_value")
+        assert event.sub_digest == logout_event_digest("")
+
+        with CaptureQueriesContext(connection) as context:
+            OIDCBackChannelLogoutEvent.objects.is_session_terminated_for_token(
+                logout_token
+            )
+        sql = context.captured_queries[0]["sql"]
+        assert '"iss_digest"' in sql
+        assert '"sid_digest"' in sql
+
     def test_receiving_the_same_logout_token_more_than_once_has_no_effect(self):
         logout_token = JWT(
             encoded_jwt_factory(iss=ISSUER1, sub="sub_value", sid="sid_value")
@@ -68,6 +105,227 @@ class TestOIDCBackChannelLogoutEvent:
         assert OIDCBackChannelLogoutEvent.objects.count() == 1
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("index_interval", [None, 0])
+class TestSubjectTermination:
+    @pytest.fixture(autouse=True)
+    def enable_sub_termination(self, settings, index_interval):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_SUB_TERMINATION = True
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_INDEX_REFRESH_INTERVAL = index_interval
+
+    @staticmethod
+    def receive_logout(**claims):
+        logout_token = JWT(encoded_jwt_factory(iss=ISSUER1, **claims))
+        OIDCBackChannelLogoutEvent.objects.logout_token_received(logout_token)
+
+    @staticmethod
+    def is_terminated(issued_at, **claims):
+        token = JWT(encoded_jwt_factory(iss=ISSUER1, iat=issued_at, **claims))
+        return OIDCBackChannelLogoutEvent.objects.is_session_terminated_for_token(token)
+
+    def test_tokens_issued_before_the_logout_are_terminated(self):
+        issued_at = unix_timestamp_now() - 10
+        self.receive_logout(sub="sub_value")
+
+        assert self.is_terminated(issued_at, sub="sub_value") is True
+        assert self.is_terminated(issued_at, sub="sub_value", sid="sid") is True
+        assert self.is_terminated(issued_at, sub="other_sub_value") is False
+
+    def test_tokens_issued_after_the_logout_are_not_terminated(self):
+        self.receive_logout(sub="sub_value")
+
+        issued_at = unix_timestamp_now() + 10
+        assert self.is_terminated(issued_at, sub="sub_value") is False
+
+    def test_tokens_issued_in_the_second_of_the_logout_are_not_terminated(self):
+        self.receive_logout(sub="sub_value")
+        received_at = OIDCBackChannelLogoutEvent.objects.get().created_at
+
+        issued_at = int(received_at.timestamp())
+        assert self.is_terminated(issued_at, sub="sub_value") is False
+        assert self.is_terminated(issued_at - 1, sub="sub_value") is True
+
+    def test_tokens_without_iat_are_not_terminated_by_the_subject(self):
+        self.receive_logout(sub="sub_value")
+        self.receive_logout(sub="sub_value", sid="sid_value")
+
+        assert self.is_terminated(None, sub="sub_value") is False
+        assert self.is_terminated(None, sub="sub_value", sid="sid_value") is True
+
+    def test_logouts_with_a_sid_terminate_only_that_session(self):
+        issued_at = unix_timestamp_now() - 10
+        self.receive_logout(sub="sub_value", sid="sid_value")
+
+        assert self.is_terminated(issued_at, sub="sub_value", sid="sid_value") is True
+        assert self.is_terminated(issued_at, sub="sub_value", sid="other") is False
+        assert self.is_terminated(issued_at, sub="sub_value") is False
+
+    def test_subject_is_checked_with_a_single_query(self, django_assert_num_queries):
+        self.receive_logout(sub="sub_value")
+
+        with django_assert_num_queries(1):
+            self.is_terminated(unix_timestamp_now(), sub="sub_value", sid="sid_value")
+
+
+@pytest.mark.django_db
+class TestDeleteExpiredLogoutEvents:
+    @staticmethod
+    def create_event(sid, age):
+        return OIDCBackChannelLogoutEvent.objects.create(
+            iss=ISSUER1, sid=sid, created_at=timezone.now() - age
+        )
+
+    def test_events_older_than_the_retention_are_deleted_in_chunks(self, settings):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION = 60 * 60
+        for i in range(5):
+            self.create_event(f"expired_{i}", datetime.timedelta(hours=2))
+        kept = self.create_event("kept", datetime.timedelta(minutes=1))
+
+        with CaptureQueriesContext(connection) as context:
+            deleted = OIDCBackChannelLogoutEvent.objects.delete_expired(chunk_size=2)
+
+        deletes = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith("DELETE")
+        ]
+        assert len(deletes) == 3
+        assert deleted == 5
+        assert list(OIDCBackChannelLogoutEvent.objects.all()) == [kept]
+
+    def test_retention_can_be_given_as_an_argument(self):
+        self.create_event("expired", datetime.timedelta(minutes=2))
+
+        deleted = OIDCBackChannelLogoutEvent.objects.delete_expired(
+            datetime.timedelta(minutes=1)
+        )
+
+        assert deleted == 1
+
+    def test_retention_is_required(self):
+        with pytest.raises(ImproperlyConfigured):
+            OIDCBackChannelLogoutEvent.objects.delete_expired()
+
+    def test_management_command_deletes_expired_events(self):
+        self.create_event("expired", datetime.timedelta(minutes=2))
+        stdout = io.StringIO()
+
+        call_command("delete_expired_logout_events", "--retention=60", stdout=stdout)
+
+        assert OIDCBackChannelLogoutEvent.objects.count() == 0
+        assert "Deleted 1 logout events" in stdout.getvalue()
+
+
+@pytest.mark.django_db
+class TestTerminatedSessionIndex:
+    @pytest.fixture(autouse=True)
+    def enable_index(self, settings):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_INDEX_REFRESH_INTERVAL = 10
+
+    @pytest.fixture
+    def clock(self, mocker):
+        clock = mocker.patch("helusers.models.time.monotonic")
+        clock.return_value = 1000.0
+        return clock
+
+    @staticmethod
+    def is_terminated(sid):
+        token = JWT(encoded_jwt_factory(iss=ISSUER1, sub="sub_value", sid=sid))
+        return OIDCBackChannelLogoutEvent.objects.is_session_terminated_for_token(token)
+
+    def test_sessions_are_checked_without_queries_between_refreshes(
+        self, clock, django_assert_num_queries
+    ):
+        OIDCBackChannelLogoutEvent.objects.create(iss=ISSUER1, sid="sid_value")
+
+        with django_assert_num_queries(1):
+            assert self.is_terminated("sid_value") is True
+        with django_assert_num_queries(0):
+            assert self.is_terminated("sid_value") is True
+            assert self.is_terminated("other_sid_value") is False
+
+    def test_events_received_in_this_process_are_seen_immediately(self, clock):
+        assert self.is_terminated("sid_value") is False
+
+        logout_token = JWT(encoded_jwt_factory(iss=ISSUER1, sid="sid_value"))
+        OIDCBackChannelLogoutEvent.objects.logout_token_received(logout_token)
+
+        assert self.is_terminated("sid_value") is True
+
+    def test_events_received_elsewhere_are_seen_after_the_interval(self, clock):
+        assert self.is_terminated("sid_value") is False
+        OIDCBackChannelLogoutEvent.objects.create(iss=ISSUER1, sid="sid_value")
+
+        clock.return_value += 9
+        assert self.is_terminated("sid_value") is False
+
+        clock.return_value += 1
+        assert self.is_terminated("sid_value") is True
+
+    def test_only_new_events_are_read_on_refresh(self, clock):
+        old_event = OIDCBackChannelLogoutEvent.objects.create(
+            iss=ISSUER1,
+            sid="old_sid_value",
+            created_at=timezone.now() - datetime.timedelta(hours=1),
+        )
+        OIDCBackChannelLogoutEvent.objects.create(iss=ISSUER1, sid="sid_value")
+        assert self.is_terminated("old_sid_value") is True
+        OIDCBackChannelLogoutEvent.objects.create(iss=ISSUER1, sid="late_sid_value")
+        old_event.sid = "changed_sid_value"
+        old_event.save()
+
+        clock.return_value += 10
+        assert self.is_terminated("late_sid_value") is True
+        assert self.is_terminated("changed_sid_value") is False
+
+    def test_async_check_refreshes_in_a_thread_only_when_due(self, clock, mocker):
+        token = JWT(encoded_jwt_factory(iss=ISSUER1, sub="sub_value", sid="sid"))
+        is_terminated = async_to_sync(
+            OIDCBackChannelLogoutEvent.objects.ais_session_terminated_for_token
+        )
+        assert self.is_terminated("sid") is False
+        sync_to_async = mocker.spy(helusers.models, "sync_to_async")
+
+        assert is_terminated(token) is False
+        assert sync_to_async.call_count == 0
+
+        clock.return_value += 10
+        assert is_terminated(token) is False
+        assert sync_to_async.call_count == 1
+
+    def test_expired_events_are_removed_from_the_index(self, clock, settings, mocker):
+        settings.HELUSERS_BACK_CHANNEL_LOGOUT_EVENT_RETENTION = 60 * 60
+        OIDCBackChannelLogoutEvent.objects.create(
+            iss=ISSUER1,
+            sid="sid_value",
+            created_at=timezone.now() - datetime.timedelta(minutes=59),
+        )
+        assert self.is_terminated("sid_value") is True
+
+        clock.return_value += 10
+        later = timezone.now() + datetime.timedelta(minutes=2)
+        mocker.patch("helusers.models.timezone.now", return_value=later)
+        assert self.is_terminated("sid_value") is False
+
+
+@pytest.mark.django_db
+def test_ad_groups_created_concurrently_are_not_duplicated(mocker):
+    existing = ADGroup.objects.create(name="group", display_name="Group")
+    # Simulate another process creating the group after the lookup
+    mocker.patch.object(
+        ADGroup.objects,
+        "filter",
+        side_effect=[ADGroup.objects.none(), ADGroup.objects.all()],
+    )
+
+    ad_groups = get_or_create_ad_groups({"group": "GROUP", "other": "Other"})
+
+    mocker.stopall()
+    assert ADGroup.objects.filter(name="group").count() == 1
+    assert ad_groups["group"] == existing.id
+    assert ad_groups["other"] == ADGroup.objects.get(name="other").id
+
+
 @pytest.mark.django_db
 class TestUserAdGroups:
     ALL_AD_GROUPS_MAPPING = (
@@ -241,3 +499,113 @@ class TestUserAdGroups:
         assert sorted([group.name for group in user.groups.all()]) == list(
             new_groups_names
         )
+
+    def test_missing_ad_groups_are_created_with_one_query(self):
+        ADGroup.objects.create(name="ad_group_1", display_name="AD_GROUP_1")
+        user = user_model.objects.create(username="testguy")
+
+        with CaptureQueriesContext(connection) as context:
+            user.update_ad_groups(["AD_GROUP_1", "Ad_Group_2", "AD_GROUP_2", "Group3"])
+
+        inserts = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith("INSERT")
+            and '"helusers_adgroup" ' in query["sql"]
+        ]
+        assert len(inserts) == 1
+        assert sorted(ADGroup.objects.values_list("name", "display_name")) == [
+            ("ad_group_1", "AD_GROUP_1"),
+            ("ad_group_2", "Ad_Group_2"),
+            ("group3", "Group3"),
+        ]
+        assert sorted(user.ad_groups.values_list("name", flat=True)) == [
+            "ad_group_1",
+            "ad_group_2",
+            "group3",
+        ]
+
+    def test_user_is_not_locked_when_ad_groups_are_unchanged(self):
+        user = user_model.objects.create(username="testguy")
+        user.update_ad_groups(["ad_group_1", "ad_group_2"])
+
+        with CaptureQueriesContext(connection) as context:
+            user.update_ad_groups(["AD_GROUP_2", "ad_group_1"])
+
+        assert not any(
+            query["sql"].startswith(("INSERT", "UPDATE", "DELETE", "SAVEPOINT"))
+            for query in context.captured_queries
+        )
+
+
+@pytest.mark.django_db
+class TestADGroupMappingCache:
+    @pytest.fixture(autouse=True)
+    def enable_mapping_cache(self, settings):
+        settings.HELUSERS_AD_GROUP_MAPPING_CACHE = "default"
+        cache.clear()
+        yield
+        cache.clear()
+
+    @staticmethod
+    def create_mapping(ad_group_name, group_name):
+        return ADGroupMapping.objects.create(
+            ad_group=ADGroup.objects.get_or_create(
+                name=ad_group_name, display_name=ad_group_name
+            )[0],
+            group=Group.objects.get_or_create(name=group_name)[0],
+        )
+
+    def test_mapping_is_loaded_only_once(self, django_assert_num_queries):
+        mapping = self.create_mapping("ad_group", "group")
+
+        with django_assert_num_queries(1):
+            get_ad_group_mapping()
+        with django_assert_num_queries(0):
+            index = get_ad_group_mapping()
+
+        assert index.groups_for({mapping.ad_group_id}) == {mapping.group_id}
+
+    def test_async_version_is_the_same_as_the_sync_version(self):
+        assert async_to_sync(aget_ad_group_mapping_version)() == (
+            get_ad_group_mapping_version()
+        )
+
+    def test_saving_a_mapping_reloads_the_mapping(self):
+        get_ad_group_mapping()
+
+        mapping = self.create_mapping("ad_group", "group")
+
+        assert get_ad_group_mapping().all_groups == {mapping.group_id}
+
+    def test_deleting_a_mapping_reloads_the_mapping(self):
+        mapping = self.create_mapping("ad_group", "group")
+        get_ad_group_mapping()
+
+        mapping.delete()
+
+        assert get_ad_group_mapping().all_groups == set()
+
+    def test_mapping_changes_are_applied_to_users(self):
+        user = user_model.objects.create(username="testguy")
+        self.create_mapping("ad_group_1", "group_1")
+        user.update_ad_groups(["ad_group_1", "ad_group_2"])
+        self.create_mapping("ad_group_2", "group_2")
+
+        user.update_ad_groups(["ad_group_1", "ad_group_2"])
+
+        assert sorted(user.groups.values_list("name", flat=True)) == [
+            "group_1",
+            "group_2",
+        ]
+
+    def test_unchanged_groups_are_not_synced_again(self):
+        user = user_model.objects.create(username="testguy")
+        self.create_mapping("ad_group_1", "group_1")
+        user.update_ad_groups(["ad_group_1", "ad_group_2"])
+
+        with CaptureQueriesContext(connection) as context:
+            user.update_ad_groups(["AD_GROUP_2", "ad_group_1"])
+
+        assert len(context.captured_queries) == 1
+        assert list(user.groups.values_list("name", flat=True)) == ["group_1"]
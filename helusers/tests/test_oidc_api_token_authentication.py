@@ -2,6 +2,7 @@ import pytest
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
 
 from helusers._oidc_auth_impl import ApiTokenAuthentication
 from helusers.tests.test_jwt_token_authentication import (  # noqa: F401
@@ -91,3 +92,54 @@ def test_last_api_use_updated_on_authentication():
     auth = do_authentication(sut=ApiTokenAuthentication())
     user = auth.user
     assert user.last_api_use == timezone.now().date()
+
+
+class TestLazyUserResolution:
+    @pytest.fixture(autouse=True)
+    def lazy_user_resolution(self, settings):
+        settings.OIDC_API_TOKEN_AUTH = {
+            **settings.OIDC_API_TOKEN_AUTH,
+            "LAZY_USER_RESOLUTION": True,
+        }
+
+    @pytest.mark.django_db
+    def test_user_is_not_resolved_until_used(self, settings, django_assert_num_queries):
+        settings.OIDC_API_TOKEN_AUTH = {
+            **settings.OIDC_API_TOKEN_AUTH,
+            "API_AUTHORIZATION_FIELD": "https://example.com",
+        }
+
+        with django_assert_num_queries(0):
+            auth = do_authentication(
+                sut=ApiTokenAuthentication(), **{"https://example.com": ["api_scope"]}
+            )
+            assert auth.has_api_scopes("api_scope") is True
+            assert auth.has_api_scopes("other_scope") is False
+
+        assert get_user_model().objects.count() == 0
+
+        assert auth.user.uuid == USER_UUID
+        assert get_user_model().objects.count() == 1
+
+    @pytest.mark.django_db
+    def test_last_api_use_is_updated_when_user_is_resolved(self):
+        auth = do_authentication(sut=ApiTokenAuthentication())
+
+        assert auth.user.last_api_use == timezone.now().date()
+        user = get_user_model().objects.get(uuid=USER_UUID)
+        assert user.last_api_use == timezone.now().date()
+
+    @pytest.mark.django_db
+    def test_resolver_errors_are_raised_when_user_is_used(self, settings):
+        settings.OIDC_API_TOKEN_AUTH = {
+            **settings.OIDC_API_TOKEN_AUTH,
+            "USER_RESOLVER": _failing_user_resolver,
+        }
+        auth = do_authentication(sut=ApiTokenAuthentication())
+
+        with pytest.raises(AuthenticationFailed, match="Unknown user"):
+            str(auth.user)
+
+
+def _failing_user_resolver(request, payload):
+    raise ValueError("Unknown user")
@@ -1,8 +1,29 @@
+import threading
 import time
 
-from helusers.oidc import OIDCConfig
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.test import RequestFactory
+from jose import jwt
+from rest_framework.exceptions import AuthenticationFailed
+
+from helusers._oidc_auth_impl import ApiTokenAuthentication
+from helusers.jwt import KeySet
+from helusers.oidc import (
+    IssuerRegistry,
+    KeyCacheInfo,
+    OIDCConfig,
+    get_key_set,
+    get_keys,
+    issuer_registry,
+)
 from helusers.settings import api_token_auth_settings
 
+from .conftest import AUDIENCE, ISSUER1, unix_timestamp_now
+from .keys import rsa_key
+
 
 def test_keys_are_returned_and_cached_with_an_expiration_time(
     auth_server, stub_responses
@@ -23,3 +44,321 @@ def test_keys_are_returned_and_cached_with_an_expiration_time(
 
     assert stub_responses.assert_call_count(auth_server.config_url, 2) is True
     assert stub_responses.assert_call_count(auth_server.jwks_url, 2) is True
+
+
+def test_issuer_registry_returns_the_same_config_for_an_issuer(auth_server):
+    registry = IssuerRegistry()
+
+    assert registry.get(auth_server.issuer) is registry.get(auth_server.issuer)
+
+
+def test_keys_are_fetched_once_for_all_authenticator_instances(
+    auth_server, stub_responses
+):
+    issuer_registry.clear()
+
+    for _ in range(3):
+        config = ApiTokenAuthentication().get_oidc_config(auth_server.issuer)
+        assert config.keys() == auth_server.keys_response
+
+    assert stub_responses.assert_call_count(auth_server.config_url, 1) is True
+    assert stub_responses.assert_call_count(auth_server.jwks_url, 1) is True
+    assert issuer_registry.cache_info()[auth_server.issuer] == KeyCacheInfo(
+        hits=2, misses=1
+    )
+
+
+def test_get_keys_returns_the_jwks_of_the_issuer(auth_server):
+    assert get_keys(auth_server.issuer) == auth_server.keys_response
+    assert isinstance(get_key_set(auth_server.issuer), KeySet)
+
+
+def test_key_ids_are_not_fetched_again_when_keys_have_no_kid(
+    auth_server, stub_responses
+):
+    config = OIDCConfig(auth_server.issuer)
+
+    assert config.key_set("kid1").find("kid1", "RS256")
+    assert stub_responses.assert_call_count(auth_server.jwks_url, 1) is True
+
+
+def test_stored_keys_are_returned_without_a_worker_thread(auth_server, mocker):
+    config = OIDCConfig(auth_server.issuer)
+    key_set = config.key_set()
+    sync_to_async = mocker.patch("helusers.oidc.sync_to_async")
+
+    assert async_to_sync(config.akey_set)() is key_set
+    assert sync_to_async.call_count == 0
+
+
+def test_keys_are_looked_up_in_a_worker_thread_while_the_lock_is_held(
+    auth_server, mocker
+):
+    config = OIDCConfig(auth_server.issuer)
+    config.key_set()
+
+    async def key_set_in_thread(key_id):
+        return "key set"
+
+    mocker.patch("helusers.oidc.sync_to_async", return_value=key_set_in_thread)
+
+    with config._lock:
+        assert async_to_sync(config.akey_set)() == "key set"
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TestBackgroundRefresh:
+    @pytest.fixture(autouse=True)
+    def enable_background_refresh(self, settings):
+        oidc_settings = settings.OIDC_API_TOKEN_AUTH.copy()
+        oidc_settings["OIDC_CONFIG_REFRESH_AHEAD_TIME"] = 1
+        settings.OIDC_API_TOKEN_AUTH = oidc_settings
+
+    @pytest.fixture
+    def clock(self, mocker):
+        clock = mocker.patch("helusers.oidc.time.monotonic")
+        clock.return_value = 1000
+        return clock
+
+    @pytest.fixture
+    def fetch_blocking_after_first_call(self, mocker, auth_server):
+        release = threading.Event()
+        fetch = mocker.patch.object(OIDCConfig, "_fetch_keys")
+
+        def fetch_keys(force=False):
+            if fetch.call_count > 1:
+                release.wait(5)
+            return auth_server.keys_response
+
+        fetch.side_effect = fetch_keys
+        yield fetch
+        release.set()
+
+    def test_keys_are_refreshed_before_they_expire(
+        self, auth_server, stub_responses, clock
+    ):
+        config = OIDCConfig(auth_server.issuer)
+        assert config.keys() == auth_server.keys_response
+
+        clock.return_value += 1.5
+        assert config.keys() == auth_server.keys_response
+
+        wait_until(lambda: not config._refreshing)
+        assert stub_responses.assert_call_count(auth_server.jwks_url, 2) is True
+
+    def test_expired_keys_are_used_while_a_single_refresh_is_in_flight(
+        self, auth_server, clock, fetch_blocking_after_first_call
+    ):
+        config = OIDCConfig(auth_server.issuer)
+        key_set = config.key_set()
+
+        clock.return_value += 10
+        for _ in range(5):
+            assert config.key_set() is key_set
+
+        wait_until(lambda: fetch_blocking_after_first_call.call_count > 1)
+        assert fetch_blocking_after_first_call.call_count == 2
+
+    def test_failed_refresh_is_retried_only_after_a_delay(
+        self, auth_server, clock, mocker
+    ):
+        config = OIDCConfig(auth_server.issuer)
+        key_set = config.key_set()
+        fetch = mocker.patch.object(
+            OIDCConfig, "_fetch_keys", side_effect=RuntimeError("failure")
+        )
+
+        clock.return_value += 10
+        assert config.key_set() is key_set
+        wait_until(lambda: not config._refreshing)
+        assert config.key_set() is key_set
+        assert fetch.call_count == 1
+
+        clock.return_value += OIDCConfig.REFRESH_RETRY_DELAY
+        assert config.key_set() is key_set
+        wait_until(lambda: fetch.call_count > 1)
+        assert fetch.call_count == 2
+
+
+class TestUnknownKeyId:
+    @pytest.fixture
+    def clock(self, mocker):
+        clock = mocker.patch("helusers.oidc.time.monotonic")
+        clock.return_value = 1000
+        return clock
+
+    @pytest.fixture
+    def rotating_auth_server(self, auth_server, stub_responses):
+        stub_responses.replace(
+            "GET",
+            auth_server.jwks_url,
+            json={"keys": [dict(auth_server.key.public_key_jwk, kid="old")]},
+        )
+        return auth_server
+
+    def rotate_keys(self, auth_server, stub_responses):
+        stub_responses.replace(
+            "GET",
+            auth_server.jwks_url,
+            json={"keys": [dict(auth_server.key.public_key_jwk, kid="new")]},
+        )
+
+    def test_keys_are_fetched_immediately_for_an_unknown_key_id(
+        self, rotating_auth_server, stub_responses, clock
+    ):
+        config = OIDCConfig(rotating_auth_server.issuer)
+        assert "old" in config.key_set("old")
+
+        self.rotate_keys(rotating_auth_server, stub_responses)
+
+        assert "new" in config.key_set("new")
+        assert stub_responses.assert_call_count(rotating_auth_server.jwks_url, 2)
+
+    def test_fetching_for_unknown_key_ids_is_rate_limited(
+        self, rotating_auth_server, stub_responses, clock, settings
+    ):
+        oidc_settings = settings.OIDC_API_TOKEN_AUTH.copy()
+        oidc_settings["OIDC_CONFIG_EXPIRATION_TIME"] = 1000
+        oidc_settings["OIDC_CONFIG_UNKNOWN_KID_REFETCH_INTERVAL"] = 60
+        settings.OIDC_API_TOKEN_AUTH = oidc_settings
+
+        config = OIDCConfig(rotating_auth_server.issuer)
+        config.key_set("unknown1")
+        config.key_set("unknown2")
+        assert stub_responses.assert_call_count(rotating_auth_server.jwks_url, 2)
+
+        clock.return_value += 61
+        self.rotate_keys(rotating_auth_server, stub_responses)
+
+        assert "new" in config.key_set("new")
+        assert stub_responses.assert_call_count(rotating_auth_server.jwks_url, 3)
+
+    def test_key_ids_missing_after_fetching_are_not_fetched_again(
+        self, rotating_auth_server, stub_responses, clock
+    ):
+        config = OIDCConfig(rotating_auth_server.issuer)
+        config.key_set("forged")
+
+        clock.return_value += 1
+        config.key_set("forged")
+
+        assert stub_responses.assert_call_count(rotating_auth_server.jwks_url, 2)
+
+    def test_failing_fetch_for_an_unknown_key_id_fails_the_authentication(
+        self, rotating_auth_server, clock, mocker, monkeypatch
+    ):
+        monkeypatch.setattr(issuer_registry, "_configs", {})
+        config = issuer_registry.get(rotating_auth_server.issuer)
+        key_set = config.key_set("old")
+        fetch = mocker.patch.object(
+            OIDCConfig, "_fetch_keys", side_effect=requests.ConnectionError
+        )
+        now = unix_timestamp_now()
+        encoded_jwt = jwt.encode(
+            {"iss": ISSUER1, "sub": "sub", "aud": AUDIENCE, "exp": now + 10},
+            key=rsa_key.private_key_pem,
+            algorithm=rsa_key.jose_algorithm,
+            headers={"kid": "unknown"},
+        )
+        request = RequestFactory().get(
+            "/path", HTTP_AUTHORIZATION=f"Bearer {encoded_jwt}"
+        )
+
+        with pytest.raises(AuthenticationFailed):
+            ApiTokenAuthentication().authenticate(request)
+
+        assert fetch.call_count == 1
+        assert config.key_set("unknown") is key_set
+        assert fetch.call_count == 1
+
+    def test_other_callers_are_not_blocked_by_fetching_for_an_unknown_key_id(
+        self, rotating_auth_server, mocker
+    ):
+        config = OIDCConfig(rotating_auth_server.issuer)
+        key_set = config.key_set("old")
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def fetch_keys(force=False):
+            fetching.set()
+            release.wait(5)
+            return {"keys": [dict(rotating_auth_server.key.public_key_jwk, kid="new")]}
+
+        mocker.patch.object(OIDCConfig, "_fetch_keys", side_effect=fetch_keys)
+        thread = threading.Thread(target=config.key_set, args=("new",))
+        thread.start()
+        try:
+            assert fetching.wait(5)
+            assert config.key_set("old") is key_set
+            assert config.key_set("other") is key_set
+        finally:
+            release.set()
+            thread.join(5)
+
+        assert "new" in config.key_set("new")
+
+
+class TestSharedCache:
+    @pytest.fixture(autouse=True)
+    def enable_shared_cache(self, settings):
+        oidc_settings = settings.OIDC_API_TOKEN_AUTH.copy()
+        oidc_settings["OIDC_CONFIG_CACHE"] = "default"
+        settings.OIDC_API_TOKEN_AUTH = oidc_settings
+        cache.clear()
+        yield
+        cache.clear()
+
+    def test_keys_are_shared_between_processes(self, auth_server, stub_responses):
+        process1_config = OIDCConfig(auth_server.issuer)
+        process2_config = OIDCConfig(auth_server.issuer)
+
+        assert process1_config.keys() == auth_server.keys_response
+        assert process2_config.keys() == auth_server.keys_response
+
+        assert stub_responses.assert_call_count(auth_server.config_url, 1) is True
+        assert stub_responses.assert_call_count(auth_server.jwks_url, 1) is True
+
+    def test_shared_keys_expire_at_the_same_time_in_all_processes(
+        self, auth_server, mocker
+    ):
+        wall_clock = mocker.patch("helusers.oidc.time.time", return_value=1000)
+        OIDCConfig(auth_server.issuer).keys()
+
+        wall_clock.return_value += 1.5
+        config = OIDCConfig(auth_server.issuer)
+        config.keys()
+
+        assert config._expires_at - time.monotonic() == pytest.approx(0.5, abs=0.1)
+
+    def test_unknown_key_id_bypasses_the_shared_configuration_and_keys(
+        self, auth_server, stub_responses
+    ):
+        stub_responses.replace(
+            "GET",
+            auth_server.jwks_url,
+            json={"keys": [dict(auth_server.key.public_key_jwk, kid="old")]},
+        )
+        OIDCConfig(auth_server.issuer).keys()
+
+        # The issuer moves its keys to a new location
+        new_jwks_url = f"{auth_server.issuer}/new-jwks"
+        stub_responses.replace(
+            "GET",
+            auth_server.config_url,
+            json=dict(auth_server.configuration, jwks_uri=new_jwks_url),
+        )
+        stub_responses.add(
+            "GET",
+            new_jwks_url,
+            json={"keys": [dict(auth_server.key.public_key_jwk, kid="new")]},
+        )
+
+        assert "new" in OIDCConfig(auth_server.issuer).key_set("new")
+        assert stub_responses.assert_call_count(auth_server.config_url, 2) is True
+        assert stub_responses.assert_call_count(new_jwks_url, 1) is True
+        assert "new" in OIDCConfig(auth_server.issuer).key_set()
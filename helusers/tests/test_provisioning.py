@@ -0,0 +1,127 @@
+import io
+import json
+import uuid
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management import CommandError, call_command
+
+from helusers.models import ADGroup, ADGroupMapping
+from helusers.provisioning import ProvisioningResult, provision_users, read_claims
+from helusers.user_utils import get_or_create_user
+
+user_model = get_user_model()
+
+
+def claims(**kwargs):
+    return {"sub": str(uuid.uuid4()), **kwargs}
+
+
+def test_read_claims_skips_empty_lines():
+    lines = ['{"sub": "a"}\n', "\n", '{"sub": "b"}\n']
+
+    assert list(read_claims(lines)) == [{"sub": "a"}, {"sub": "b"}]
+
+
+@pytest.mark.parametrize("line", ["not json", "[]"])
+def test_read_claims_tells_the_line_of_invalid_claims(line):
+    with pytest.raises(ValueError, match="Line 2"):
+        list(read_claims(['{"sub": "a"}', line]))
+
+
+@pytest.mark.django_db
+class TestProvisionUsers:
+    def test_users_are_created_like_by_get_or_create_user(self):
+        payload = claims(given_name="First", family_name="Last", email="a@example.com")
+
+        assert provision_users([payload]) == ProvisioningResult(1, 1, 0)
+
+        user = user_model.objects.get(uuid=payload["sub"])
+        expected = get_or_create_user(dict(payload, sub=str(uuid.uuid4())), oidc=True)
+        for field in ("first_name", "last_name", "email"):
+            assert getattr(user, field) == getattr(expected, field)
+        assert user.username.startswith("u-")
+        assert not user.has_usable_password()
+
+    def test_changed_users_are_updated(self):
+        unchanged = claims(given_name="Same")
+        changed = claims(given_name="Old")
+        provision_users([unchanged, changed])
+
+        changed["given_name"] = "New"
+        result = provision_users([unchanged, changed])
+
+        assert result == ProvisioningResult(2, 0, 1)
+        assert user_model.objects.get(uuid=changed["sub"]).first_name == "New"
+
+    def test_last_claims_of_a_user_are_used(self):
+        payload = claims(given_name="First")
+
+        provision_users([payload, dict(payload, given_name="Second")])
+
+        assert user_model.objects.get(uuid=payload["sub"]).first_name == "Second"
+
+    def test_users_are_saved_in_batches(self, django_assert_max_num_queries):
+        payloads = [claims(ad_groups=["group_1", f"group_{i}"]) for i in range(20)]
+        batches = []
+
+        with django_assert_max_num_queries(2 * 10 + 2):
+            provision_users(payloads, batch_size=10, progress=batches.append)
+
+        assert batches == [ProvisioningResult(10, 10, 0), ProvisioningResult(20, 20, 0)]
+        assert user_model.objects.count() == 20
+
+    def test_ad_groups_and_mapped_groups_are_set(self):
+        group = Group.objects.create(name="group")
+        ADGroupMapping.objects.create(
+            ad_group=ADGroup.objects.create(name="mapped", display_name="Mapped"),
+            group=group,
+        )
+        payload = claims(ad_groups=["Mapped", "Other"])
+        provision_users([payload])
+
+        user = user_model.objects.get(uuid=payload["sub"])
+        assert sorted(user.ad_groups.values_list("name", flat=True)) == [
+            "mapped",
+            "other",
+        ]
+        assert list(user.groups.all()) == [group]
+
+        payload["ad_groups"] = ["other", "new"]
+        provision_users([payload])
+
+        assert sorted(user.ad_groups.values_list("name", flat=True)) == [
+            "new",
+            "other",
+        ]
+        assert list(user.groups.all()) == []
+
+    def test_unmapped_groups_of_users_are_kept(self):
+        payload = claims(ad_groups=[])
+        provision_users([payload])
+        user = user_model.objects.get(uuid=payload["sub"])
+        group = Group.objects.create(name="manual")
+        user.groups.add(group)
+
+        provision_users([payload])
+
+        assert list(user.groups.all()) == [group]
+
+    def test_management_command_provisions_users_from_a_file(self, tmp_path):
+        path = tmp_path / "users.jsonl"
+        payloads = [claims(given_name=f"User {i}") for i in range(3)]
+        path.write_text("\n".join(json.dumps(payload) for payload in payloads))
+        stdout = io.StringIO()
+
+        call_command("provision_users", str(path), "--batch-size=2", stdout=stdout)
+
+        assert user_model.objects.count() == 3
+        assert "Provisioned 3 users" in stdout.getvalue()
+
+    def test_management_command_reports_invalid_lines(self, tmp_path):
+        path = tmp_path / "users.jsonl"
+        path.write_text("{}\n")
+
+        with pytest.raises(CommandError, match="sub missing"):
+            call_command("provision_users", str(path), stdout=io.StringIO())
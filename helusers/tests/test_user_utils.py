@@ -1,8 +1,25 @@
+import datetime
+import threading
+import time
 import uuid
 
 import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_save, pre_save
+from django.test.utils import CaptureQueriesContext
 
-from helusers.user_utils import get_or_create_user
+from helusers.models import ADGroupMapping
+from helusers.user_utils import (
+    _insert_user,
+    _KeyedLocks,
+    forget_user,
+    get_or_create_user,
+    populate_user,
+    update_user,
+)
 
 
 @pytest.mark.django_db
@@ -18,3 +35,237 @@ def test_get_or_create_user_always_returns_a_user_with_uuid_type_id():
     assert user1.uuid == user_uuid
     assert user2.uuid == user_uuid
     assert user1 == user2
+
+
+@pytest.mark.django_db
+class TestUserCreation:
+    @pytest.fixture
+    def payload(self):
+        return {"sub": str(uuid.uuid4()), "given_name": "First"}
+
+    @pytest.fixture
+    def post_save_calls(self):
+        calls = []
+
+        def receiver(sender, created, **kwargs):
+            calls.append(created)
+
+        post_save.connect(receiver, sender=get_user_model(), weak=False)
+        yield calls
+        post_save.disconnect(receiver, sender=get_user_model())
+
+    @pytest.fixture
+    def pre_save_calls(self):
+        calls = []
+
+        def receiver(sender, instance, **kwargs):
+            calls.append(instance)
+
+        pre_save.connect(receiver, sender=get_user_model(), weak=False)
+        yield calls
+        pre_save.disconnect(receiver, sender=get_user_model())
+
+    @pytest.fixture
+    def postgresql(self, mocker):
+        # SQLite ignores conflicts too, so the upsert can be tested with it
+        mocker.patch.object(connection, "vendor", "postgresql")
+
+    @pytest.mark.usefixtures("postgresql")
+    def test_new_user_is_inserted_once(self, payload, post_save_calls):
+        with CaptureQueriesContext(connection) as context:
+            user = get_or_create_user(payload, oidc=True)
+
+        user_table = get_user_model()._meta.db_table
+        inserts = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith("INSERT") and f'"{user_table}"' in query["sql"]
+        ]
+        assert len(inserts) == 1
+        assert user.first_name == "First"
+        assert post_save_calls == [True]
+
+    @pytest.mark.usefixtures("postgresql")
+    def test_concurrently_inserted_user_is_returned(
+        self, payload, post_save_calls, pre_save_calls
+    ):
+        existing = get_or_create_user(payload, oidc=True)
+        post_save_calls.clear()
+
+        user = _insert_user(get_user_model(), existing.uuid, payload, True)
+
+        assert user == existing
+        assert get_user_model().objects.count() == 1
+        assert post_save_calls == []
+        assert pre_save_calls == []
+
+    def test_user_is_saved_on_other_databases(
+        self, payload, post_save_calls, pre_save_calls
+    ):
+        user = get_or_create_user(payload, oidc=True)
+
+        assert user.first_name == "First"
+        assert post_save_calls == [True]
+        assert pre_save_calls == [user]
+
+
+@pytest.mark.django_db
+def test_update_user_saves_only_the_changed_fields():
+    payload = {"sub": str(uuid.uuid4()), "given_name": "First", "email": "a@x.fi"}
+    user = get_or_create_user(payload, oidc=True)
+    # Changed concurrently by another request
+    get_user_model().objects.filter(pk=user.pk).update(
+        last_api_use=datetime.date(2024, 1, 1)
+    )
+
+    update_user(user, {"given_name": "Changed", "email": "a@x.fi"}, oidc=True)
+
+    user.refresh_from_db()
+    assert user.first_name == "Changed"
+    assert user.last_api_use == datetime.date(2024, 1, 1)
+
+
+def test_populate_user_returns_the_changed_fields():
+    user = get_user_model()(first_name="First", email="a@x.fi")
+
+    changed = populate_user(user, {"first_name": "First", "email": "b@x.fi"})
+
+    assert changed == {"email"}
+    assert user.email == "b@x.fi"
+
+
+def test_keyed_locks_serialize_callers_with_the_same_key():
+    locks = _KeyedLocks()
+    events = []
+
+    def worker(name):
+        with locks("key"):
+            events.append(f"{name} start")
+            time.sleep(0.01)
+            events.append(f"{name} end")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(0, len(events), 2):
+        assert events[i].split()[0] == events[i + 1].split()[0]
+    assert locks._locks == {}
+
+
+@pytest.mark.django_db
+class TestClaimsFingerprint:
+    @pytest.fixture(autouse=True)
+    def enable_fingerprint_cache(self, settings):
+        settings.HELUSERS_USER_FINGERPRINT_CACHE = "default"
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def payload(self):
+        return {
+            "sub": str(uuid.uuid4()),
+            "given_name": "First",
+            "ad_groups": ["group"],
+            "exp": 1,
+        }
+
+    def test_unchanged_claims_need_a_single_query(
+        self, payload, django_assert_num_queries
+    ):
+        user = get_or_create_user(payload, oidc=True)
+
+        payload["exp"] = 2
+        with django_assert_num_queries(1):
+            assert get_or_create_user(payload, oidc=True) == user
+
+    def test_changed_claims_update_the_user(self, payload):
+        get_or_create_user(payload, oidc=True)
+
+        payload["given_name"] = "Changed"
+        user = get_or_create_user(payload, oidc=True)
+
+        user.refresh_from_db()
+        assert user.first_name == "Changed"
+
+    def test_changed_ad_groups_update_the_user(self, payload):
+        get_or_create_user(payload, oidc=True)
+
+        payload["ad_groups"] = ["other_group"]
+        user = get_or_create_user(payload, oidc=True)
+
+        assert [group.name for group in user.ad_groups.all()] == ["other_group"]
+
+    def test_changed_ad_group_mapping_updates_the_user(self, payload, settings):
+        settings.HELUSERS_AD_GROUP_MAPPING_CACHE = "default"
+        user = get_or_create_user(payload, oidc=True)
+        ADGroupMapping.objects.create(
+            ad_group=user.ad_groups.get(), group=Group.objects.create(name="group")
+        )
+
+        user = get_or_create_user(payload, oidc=True)
+
+        assert [group.name for group in user.groups.all()] == ["group"]
+
+    def test_deleted_user_is_created_again(self, payload, django_user_model):
+        get_or_create_user(payload, oidc=True).delete()
+
+        user = get_or_create_user(payload, oidc=True)
+
+        assert django_user_model.objects.filter(pk=user.pk).exists()
+
+
+@pytest.mark.django_db
+class TestUserCache:
+    @pytest.fixture(autouse=True)
+    def enable_user_cache(self, settings):
+        settings.HELUSERS_USER_FINGERPRINT_CACHE = "default"
+        settings.HELUSERS_USER_CACHE_TIMEOUT = 60
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def payload(self):
+        return {"sub": str(uuid.uuid4()), "given_name": "First"}
+
+    def test_unchanged_user_is_resolved_without_queries(
+        self, payload, django_assert_num_queries
+    ):
+        user = get_or_create_user(payload, oidc=True)
+
+        with django_assert_num_queries(0):
+            cached_user = get_or_create_user(payload, oidc=True)
+
+        assert cached_user == user
+        assert cached_user is not user
+
+    def test_saved_user_is_removed_from_the_cache(
+        self, payload, django_assert_num_queries
+    ):
+        user = get_or_create_user(payload, oidc=True)
+        user.last_name = "Last"
+        user.save()
+
+        with django_assert_num_queries(1):
+            assert get_or_create_user(payload, oidc=True).last_name == "Last"
+
+    def test_deleted_user_is_removed_from_the_cache(self, payload, django_user_model):
+        get_or_create_user(payload, oidc=True).delete()
+
+        user = get_or_create_user(payload, oidc=True)
+
+        assert django_user_model.objects.filter(pk=user.pk).exists()
+
+    def test_forgotten_user_is_removed_from_the_cache(
+        self, payload, django_assert_num_queries
+    ):
+        get_or_create_user(payload, oidc=True)
+
+        forget_user(payload)
+
+        with django_assert_num_queries(1):
+            get_or_create_user(payload, oidc=True)
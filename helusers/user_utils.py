@@ -1,11 +1,26 @@
+import copy
+import hashlib
+import json
 import logging
+import threading
+from contextlib import contextmanager
 from uuid import UUID, uuid5
 
+from asgiref.sync import sync_to_async
+from cachetools import LRUCache, TTLCache
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import IntegrityError, transaction
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext as _
 
+from helusers.models import (
+    aget_ad_group_mapping_version,
+    get_ad_group_mapping_version,
+)
 from helusers.utils import uuid_to_username
 
 logger = logging.getLogger(__name__)
@@ -32,16 +47,22 @@ def oidc_to_user_data(payload):
     return ret
 
 
-def populate_user(user, data):
+def _get_populated_fields(user_model):
     exclude_fields = ["is_staff", "password", "is_superuser", "id"]
-    user_fields = [f.name for f in user._meta.fields if f.name not in exclude_fields]
-    changed = False
+    return [f.name for f in user_model._meta.fields if f.name not in exclude_fields]
+
+
+def populate_user(user, data):
+    """Sets the user's fields from data. Returns the set of the names of
+    the changed fields."""
+    user_fields = _get_populated_fields(user)
+    changed = set()
     for field in user_fields:
         if field in data:
             val = data[field]
             if getattr(user, field) != val:
                 setattr(user, field, val)
-                changed = True
+                changed.add(field)
 
     return changed
 
@@ -50,12 +71,36 @@ def update_user(user, payload, oidc=False):
     if oidc:
         payload = oidc_to_user_data(payload)
 
-    # Default is for Tunnistamo, Azure uses 'groups'
-    group_claim_name = getattr(settings, "HELUSERS_ADGROUPS_CLAIM", "ad_groups")
-
     changed = populate_user(user, payload)
-    if changed or not user.pk:
+    if not user.pk:
         user.save()
+    elif changed:
+        user.save(update_fields=changed)
+
+    ad_groups = _get_ad_groups(payload)
+    if ad_groups is not None:
+        user.update_ad_groups(ad_groups)
+
+
+async def aupdate_user(user, payload, oidc=False):
+    """Async version of update_user."""
+    if oidc:
+        payload = oidc_to_user_data(payload)
+
+    changed = populate_user(user, payload)
+    if not user.pk:
+        await user.asave()
+    elif changed:
+        await user.asave(update_fields=changed)
+
+    ad_groups = _get_ad_groups(payload)
+    if ad_groups is not None:
+        await sync_to_async(user.update_ad_groups)(ad_groups)
+
+
+def _get_ad_groups(payload):
+    # Default is for Tunnistamo, Azure uses 'groups'
+    group_claim_name = getattr(settings, "HELUSERS_ADGROUPS_CLAIM", "ad_groups")
 
     logger.debug("checking for AD groups in claim `%s`", group_claim_name)
 
@@ -65,12 +110,17 @@ def update_user(user, payload, oidc=False):
     if isinstance(ad_groups, list) and (
         all([isinstance(x, str) and x for x in ad_groups])
     ):
-        user.update_ad_groups(ad_groups)
+        return ad_groups
+
+    return None
 
 
 # Critical section for user creation. It is quite possible that,
 # for a new user, the first requests fired toward the API will race
-# for creating the user. All but one of these will then fail.
+# for creating the user. Within a process the requests are serialized
+# by _user_locks, and between processes by inserting the user with
+# an upsert on PostgreSQL. Otherwise all but one of these will then
+# fail and be retried.
 def _try_create_or_update(user_id, payload, oidc):
     user_id = UUID(user_id)
     user_model = get_user_model()
@@ -78,12 +128,77 @@ def _try_create_or_update(user_id, payload, oidc):
         try:
             user = user_model.objects.get(uuid=user_id)
         except user_model.DoesNotExist:
-            user = user_model(uuid=user_id)
-            user.set_unusable_password()
+            user = _insert_user(user_model, user_id, payload, oidc)
         update_user(user, payload, oidc)
     return user
 
 
+def _insert_user(user_model, user_id, payload, oidc):
+    """Inserts a new user on PostgreSQL, or returns the user if one with
+    the same UUID was inserted concurrently, using a single INSERT ... ON
+    CONFLICT DO NOTHING statement. The save() method of the user model
+    isn't called and the pre_save signal isn't sent. The post_save signal
+    is sent only if the user was inserted by this call.
+
+    On other databases, returns an unsaved user instead, and saving it
+    raises an IntegrityError if the user was inserted concurrently."""
+    user = user_model(uuid=user_id)
+    user.set_unusable_password()
+
+    using = router.db_for_write(user_model)
+    if connections[using].vendor != "postgresql":
+        return user
+
+    populate_user(user, oidc_to_user_data(payload) if oidc else payload)
+    user.clean()
+    user_model.objects.using(using).bulk_create([user], ignore_conflicts=True)
+
+    try:
+        inserted = user_model.objects.using(using).get(uuid=user_id)
+    except user_model.DoesNotExist:
+        # The insert conflicted with another user on some other column
+        raise IntegrityError(f"Could not insert user {user_id}")
+
+    # The unusable password is random, so it identifies the inserted row
+    if inserted.password == user.password:
+        post_save.send(
+            sender=user_model,
+            instance=inserted,
+            created=True,
+            raw=False,
+            using=using,
+            update_fields=None,
+        )
+    return inserted
+
+
+class _KeyedLocks:
+    """Locks created on demand for each key and removed when unused."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def __call__(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+_user_locks = _KeyedLocks()
+
+
 def is_valid_uuid(uuid_to_test, version=None):
     try:
         uuid_obj = UUID(uuid_to_test, version=version)
@@ -166,10 +281,15 @@ def migrate_user(user_id: str, payload: dict):
         )
         return
 
+    with _migration_checked_lock:
+        if uid in _migration_checked:
+            return
+
     user_model = get_user_model()
 
     if user_model.objects.filter(uuid=uid).exists():
         logger.debug(f"User {user_id} exist, not trying to migrate.")
+        _set_migration_checked(uid)
         return
 
     users = user_model.objects.filter(email=email, username__startswith="u-")
@@ -182,13 +302,30 @@ def migrate_user(user_id: str, payload: dict):
     if user := users.first():
         logger.info(f"Migrating user {user.uuid} to {user_id}.")
 
+        user_cache.delete(user.uuid)
         user.uuid = uid
         user.username = uuid_to_username(uid)
         user.save()
 
+    # Either the user was migrated or there's nothing to migrate, and
+    # a user with the new UUID is created next. In both cases, the user
+    # with the UUID exists from now on.
+    _set_migration_checked(uid)
 
-def get_or_create_user(payload, oidc=False):
-    """Get, create or update a user based on the payload."""
+
+# UUIDs of the users for which migrate_user doesn't need to query the
+# database anymore. Bounded, so that the memory use stays constant.
+_MAX_MIGRATION_CHECKED_USERS = 10000
+_migration_checked_lock = threading.Lock()
+_migration_checked = LRUCache(maxsize=_MAX_MIGRATION_CHECKED_USERS)
+
+
+def _set_migration_checked(uid):
+    with _migration_checked_lock:
+        _migration_checked[uid] = True
+
+
+def _get_user_id(payload):
     user_id = payload.get("sub")
     if not user_id:
         msg = _("Invalid payload. sub missing")
@@ -203,20 +340,222 @@ def get_or_create_user(payload, oidc=False):
         namespace = payload.get("tid")
         user_id = convert_to_uuid(user_id, namespace)
 
+    return user_id
+
+
+class UserCache:
+    """Bounded in-process cache of resolved users by their UUID.
+
+    Used together with the claims fingerprint cache, so that users whose
+    claims haven't changed are resolved without any database queries. The
+    cache is enabled by setting HELUSERS_USER_CACHE_TIMEOUT to a number of
+    seconds. HELUSERS_USER_CACHE_SIZE limits the number of cached users.
+    A user is removed from the cache when it's saved or deleted in this
+    process, or when a back channel logout for it is received. Changes
+    made in other processes are seen after the timeout."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = None
+
+    def _get_cache(self):
+        if self._cache is None:
+            timeout = getattr(settings, "HELUSERS_USER_CACHE_TIMEOUT", 0)
+            if not timeout:
+                return None
+            maxsize = getattr(settings, "HELUSERS_USER_CACHE_SIZE", 1000)
+            self._cache = TTLCache(maxsize=maxsize, ttl=timeout)
+        return self._cache
+
+    def get(self, user_id):
+        with self._lock:
+            cache = self._get_cache()
+            user = cache.get(str(user_id)) if cache is not None else None
+        # Every caller gets its own copy, so that changes to one
+        # request's user don't leak to the others.
+        return copy.copy(user) if user is not None else None
+
+    def set(self, user_id, user):
+        with self._lock:
+            cache = self._get_cache()
+            if cache is not None:
+                cache[str(user_id)] = copy.copy(user)
+
+    def delete(self, user_id):
+        with self._lock:
+            if self._cache is not None:
+                self._cache.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache = None
+
+
+user_cache = UserCache()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _forget_changed_user(instance, **kwargs):
+    if instance.uuid:
+        user_cache.delete(instance.uuid)
+
+
+@receiver(setting_changed)
+def _reload_settings(setting, **kwargs):
+    if setting in ("HELUSERS_USER_CACHE_TIMEOUT", "HELUSERS_USER_CACHE_SIZE"):
+        user_cache.clear()
+    if setting.startswith("HELUSERS_USER_MIGRATE_"):
+        with _migration_checked_lock:
+            _migration_checked.clear()
+
+
+def forget_user(payload):
+    """Removes the user identified by the "sub" claim of the payload from
+    the user cache."""
+    try:
+        user_id = _get_user_id(payload)
+    except ValueError:
+        return
+    user_cache.delete(user_id)
+
+
+def _get_fingerprint_cache():
+    alias = getattr(settings, "HELUSERS_USER_FINGERPRINT_CACHE", None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def _fingerprint_cache_timeout():
+    return getattr(settings, "HELUSERS_USER_FINGERPRINT_CACHE_TIMEOUT", 60 * 60)
+
+
+def _fingerprint_cache_key(user_id):
+    return f"helusers:user-fingerprint:{user_id}"
+
+
+def _claims_fingerprint(payload, oidc, ad_group_mapping_version):
+    """Returns a hash of the claims that get_or_create_user stores into the
+    user. Claims that change with every token, such as "exp", are ignored.
+    The version of the AD group mapping is included, so that changes to the
+    mapping are applied to the users without waiting for their claims to
+    change."""
+    data = oidc_to_user_data(payload) if oidc else payload
+    user_fields = _get_populated_fields(get_user_model())
+    relevant = {field: data[field] for field in user_fields if field in data}
+    relevant = {
+        "oidc": oidc,
+        "fields": relevant,
+        "ad_groups": _get_ad_groups(data),
+        "ad_group_mapping": ad_group_mapping_version,
+    }
+    serialized = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def get_or_create_user(payload, oidc=False):
+    """Get, create or update a user based on the payload.
+
+    If the HELUSERS_USER_FINGERPRINT_CACHE setting names a Django cache, a
+    fingerprint of the user related claims is stored in it. When the claims
+    haven't changed since the user was last updated, the user is just
+    looked up by its UUID. The looked up users can additionally be kept in
+    memory for a short while, see UserCache."""
+    user_id = _get_user_id(payload)
+
+    cache = _get_fingerprint_cache()
+    if cache is not None:
+        fingerprint = _claims_fingerprint(payload, oidc, get_ad_group_mapping_version())
+        if cache.get(_fingerprint_cache_key(user_id)) == fingerprint:
+            user = user_cache.get(user_id)
+            if user is not None:
+                return user
+
+            user_model = get_user_model()
+            user = user_model.objects.filter(uuid=UUID(user_id)).first()
+            if user is not None:
+                user_cache.set(user_id, user)
+                return user
+
     migrate_user(user_id, payload)
 
-    try_again = False
+    user = _get_or_create_user(user_id, payload, oidc)
+
+    if cache is not None:
+        cache.set(
+            _fingerprint_cache_key(user_id), fingerprint, _fingerprint_cache_timeout()
+        )
+        user_cache.set(user_id, user)
+
+    return user
+
+
+def _get_or_create_user(user_id, payload, oidc):
+    with _user_locks(user_id):
+        try_again = False
+        try:
+            user = _try_create_or_update(user_id, payload, oidc)
+        except IntegrityError:
+            # If we get an integrity error, it probably meant a race
+            # condition with another process. Another attempt should
+            # succeed.
+            try_again = True
+        if try_again:
+            # We try again without catching exceptions this time.
+            user = _try_create_or_update(user_id, payload, oidc)
+
+    _ensure_social_account(user, user_id, payload, oidc)
+
+    return user
+
+
+async def aget_or_create_user(payload, oidc=False):
+    """Async version of get_or_create_user. Existing users are fetched and
+    updated using the async ORM interface. Creating a new user, migrating
+    a user and updating AD groups need transactions, so they are run in
+    the sync thread."""
+    user_id = _get_user_id(payload)
+    user_model = get_user_model()
+
+    cache = _get_fingerprint_cache()
+    if cache is not None:
+        fingerprint = _claims_fingerprint(
+            payload, oidc, await aget_ad_group_mapping_version()
+        )
+        if await cache.aget(_fingerprint_cache_key(user_id)) == fingerprint:
+            user = user_cache.get(user_id)
+            if user is not None:
+                return user
+
+            user = await user_model.objects.filter(uuid=UUID(user_id)).afirst()
+            if user is not None:
+                user_cache.set(user_id, user)
+                return user
+
+    if getattr(settings, "HELUSERS_USER_MIGRATE_ENABLED", False):
+        await sync_to_async(migrate_user)(user_id, payload)
+
     try:
-        user = _try_create_or_update(user_id, payload, oidc)
-    except IntegrityError:
-        # If we get an integrity error, it probably meant a race
-        # condition with another process. Another attempt should
-        # succeed.
-        try_again = True
-    if try_again:
-        # We try again without catching exceptions this time.
-        user = _try_create_or_update(user_id, payload, oidc)
+        user = await user_model.objects.aget(uuid=UUID(user_id))
+    except user_model.DoesNotExist:
+        user = await sync_to_async(_get_or_create_user)(user_id, payload, oidc)
+    else:
+        await aupdate_user(user, payload, oidc)
+
+        if "allauth.socialaccount" in settings.INSTALLED_APPS:
+            await sync_to_async(_ensure_social_account)(user, user_id, payload, oidc)
+
+    if cache is not None:
+        await cache.aset(
+            _fingerprint_cache_key(user_id), fingerprint, _fingerprint_cache_timeout()
+        )
+        user_cache.set(user_id, user)
+
+    return user
 
+
+def _ensure_social_account(user, user_id, payload, oidc):
     # If allauth.socialaccount is installed, create the SocialAcount
     # that corresponds to this user. Otherwise logins through
     # allauth will not work for the user later on.
@@ -245,5 +584,3 @@ def get_or_create_user(payload, oidc=False):
                     email=user.email.lower(), primary=True, user=user, verified=True
                 )
                 email.save()
-
-    return user
@@ -17,7 +17,12 @@ from jose import JOSEError
 
 from . import oidc
 from .jwt import JWT, ValidationError
-from .models import OIDCBackChannelLogoutEvent
+from .models import (
+    OIDCBackChannelLogoutEvent,
+    OIDCSession,
+    is_session_termination_enabled,
+)
+from .user_utils import forget_user
 
 LANGUAGE_FIELD_NAME = "ui_locales"
 
@@ -77,7 +82,7 @@ class OIDCBackChannelLogout(View):
 
             issuer = jwt.issuer
 
-            keys = oidc.get_keys(issuer)
+            keys = oidc.get_key_set(issuer, jwt.key_id)
             jwt.validate(
                 keys, oidc.accepted_audience(), required_claims={"aud", "iat", "jti"}
             )
@@ -124,6 +129,9 @@ class OIDCBackChannelLogout(View):
                 return response
 
         OIDCBackChannelLogoutEvent.objects.logout_token_received(jwt)
+        if is_session_termination_enabled():
+            OIDCSession.objects.logout_token_received(jwt)
+        forget_user(jwt.claims)
 
         return HttpResponse()
 